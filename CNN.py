@@ -9,20 +9,20 @@ import tensorflow as tf
 from datetime import datetime
 from tensorflow import keras
 
-from utils import prepareData
+from utils import listCategories, prepareDataset
 
 
-def main():
-    DATADIR = "data/mini_data"
-    CATEGORIES = os.listdir(DATADIR)
-    img_h = img_w = img_size = 256
-    train_x, test_x, train_y, test_y = prepareData(img_folder=DATADIR, img_size=img_size, sample_size=-10)
-    epoch = len(train_x)
-
+def buildModel(img_size: int, n_classes: int, decay_steps: int) -> keras.Model:
+    """
+    Builds and compiles the CNN classifier
+    :param img_size: The input height/width
+    :param n_classes: Number of categories
+    :param decay_steps: Steps between the learning rate decays
+    :return: The compiled model
+    """
     model = tf.keras.Sequential([
-        tf.keras.layers.Conv2D(20, (5, 5), input_shape=(img_h, img_w, 1), activation='relu', padding='same'),
+        tf.keras.layers.Conv2D(20, (5, 5), input_shape=(img_size, img_size, 1), activation='relu', padding='same'),
         tf.keras.layers.MaxPooling2D(pool_size=(2, 2)),
-        tf.keras.layers.Reshape((32, 32, 32, 16)),
 
         tf.keras.layers.Conv2D(40, (3, 3), activation='relu', padding='same'),
         tf.keras.layers.MaxPooling2D(pool_size=(2, 2)),
@@ -47,19 +47,30 @@ def main():
         tf.keras.layers.Dense(256, activation='relu'),
         tf.keras.layers.Dropout(0.4),
         tf.keras.layers.Dense(256, activation='relu'),
-        tf.keras.layers.Dense(len(CATEGORIES), activation='softmax')
+        tf.keras.layers.Dense(n_classes, activation='softmax')
     ])
 
     initial_learning_rate = 1e-3
     lr_schedule = keras.optimizers.schedules.ExponentialDecay(
         initial_learning_rate,
-        decay_steps=epoch * 5,
+        decay_steps=decay_steps,
         decay_rate=.1,
         staircase=True)
 
     model.compile(optimizer=keras.optimizers.Adam(learning_rate=lr_schedule),
                   loss='sparse_categorical_crossentropy',
                   metrics=['accuracy'])
+    return model
+
+
+def main():
+    DATADIR = "data/mini_data"
+    CATEGORIES = listCategories(DATADIR)
+    img_h = img_w = img_size = 256
+    train_ds, test_ds, epoch = prepareDataset(img_folder=DATADIR, img_size=img_size, sample_size=-10,
+                                              batch_size=256)
+
+    model = buildModel(img_size, len(CATEGORIES), decay_steps=epoch * 5)
     print(model.summary())
 
     log_dir = os.path.join("tf_logs\\CNN\\", datetime.now().strftime("%Y%m%d-%H%M%S/"))
@@ -67,11 +78,9 @@ def main():
     save_callback = keras.callbacks.ModelCheckpoint(log_dir, monitor='val_accuracy', verbose=True, save_best_only=True,
                                                     save_weights_only=False, mode='max', save_freq='epoch')
 
-    model.fit(x=train_x,
-              y=train_y,
-              batch_size=256,
+    model.fit(train_ds,
               epochs=100,
-              validation_data=(test_x, test_y),
+              validation_data=test_ds,
               callbacks=[tensorboard_callback,
                          save_callback])
 
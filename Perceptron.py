@@ -1,4 +1,4 @@
-import tensorflow as tf
+import tensorflow.compat.v1 as tf
 import numpy as np
 
 
@@ -19,10 +19,15 @@ class Perceptron:
             'out': tf.Variable(tf.constant(0.1, shape=[self.class_num]))
         }
 
-        tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, weights['out'])
-        tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, biases['out'])
+        # Graph collections only exist in graph mode, the eager training uses variables()
+        if not tf.executing_eagerly():
+            tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, weights['out'])
+            tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, biases['out'])
         return weights, biases
 
+    def variables(self) -> list:
+        return list(self.weights.values()) + list(self.biases.values())
+
     # Define the neural network
     def getModel(self, x: np.ndarray):
         # Output fully connected layer with a neuron for each class
@@ -1,47 +1,146 @@
-import tensorflow as tf
+import tensorflow.compat.v1 as tf
 import numpy as np
 
+# Weight layouts of the hidden layers: 'dense', 'lowrank:RANK' (U.V factors) or
+# 'blocksparse:BLOCK_SIZE:DENSITY' (only a fixed random DENSITY share of the BLOCK_SIZE x BLOCK_SIZE blocks)
+LAYER_TYPES = ('dense', 'lowrank', 'blocksparse')
+# The ':' separated arguments of every layer type
+LAYER_ARGS = {'dense': (), 'lowrank': (int,), 'blocksparse': (int, float)}
+
+
+def parseLayers(spec: str) -> (list, list):
+    """
+    Parses a hidden layers spec, comma separated SIZE[:TYPE[:ARGS]] entries, e.g.
+    "16384:lowrank:256,4096:blocksparse:64:0.1,1024"
+    :param spec: The layers spec
+    :return: The hidden layer sizes, the layer types
+    """
+    sizes = list()
+    layer_types = list()
+    for entry in spec.split(','):
+        fields = entry.strip().split(':')
+        kind, params = (fields[1], fields[2:]) if len(fields) > 1 else ('dense', [])
+        if kind not in LAYER_ARGS:
+            raise ValueError("Layer '%s': unknown type %s, use: %s" % (entry, kind, ', '.join(LAYER_TYPES)))
+        if len(params) != len(LAYER_ARGS[kind]):
+            raise ValueError("Layer '%s': %s takes %d argument(s), got %d"
+                             % (entry, kind, len(LAYER_ARGS[kind]), len(params)))
+        try:
+            values = [int(fields[0])] + [arg_type(x) for arg_type, x in zip(LAYER_ARGS[kind], params)]
+        except ValueError:
+            raise ValueError("Layer '%s': the size and arguments must be numbers" % entry)
+        if min(values) <= 0:
+            raise ValueError("Layer '%s': the size and arguments must be positive" % entry)
+        if kind == 'blocksparse' and values[2] > 1:
+            raise ValueError("Layer '%s': the density must be in (0, 1]" % entry)
+        sizes.append(values[0])
+        layer_types.append(':'.join([kind] + params))
+    return sizes, layer_types
+
 
 class SimpleAnn:
 
-    def __init__(self, hidden_lst: list, input_num: int, class_num: int):
+    def __init__(self, hidden_lst: list, input_num: int, class_num: int, layer_types: list = None):
+        """
+        :param hidden_lst: The hidden layer sizes
+        :param input_num: The input size
+        :param class_num: Number of classes
+        :param layer_types: The weight layout of every hidden layer (see LAYER_TYPES), all dense if not set
+        """
         self.hidden_layers = list(hidden_lst)
+        self.layer_types = list(layer_types) if layer_types is not None else ['dense'] * len(self.hidden_layers)
+        if len(self.layer_types) != len(self.hidden_layers):
+            raise ValueError("Expected %d layer types, got %d" % (len(self.hidden_layers), len(self.layer_types)))
         self.input_num = input_num
         self.class_num = class_num
+        # Layer key -> (input blocks of every output block, block size), for the blocksparse layers
+        self.block_index = dict()
 
         self.weights, self.biases = self.getWeights()
 
+    def getLayerWeights(self, key: str, n_in: int, n_out: int, layer_type: str, seed: int) -> dict:
+        """
+        :return: The weight variables of a layer, the initial values have the variance of the dense layer
+        """
+        kind, *params = layer_type.split(':')
+        if kind == 'dense':
+            return {key: tf.Variable(tf.random.truncated_normal([n_in, n_out], stddev=0.1))}
+        if kind == 'lowrank':
+            rank = int(params[0])
+            # U.V entries are sums of rank products, stddev of 0.1 like the dense weights
+            stddev = np.sqrt(0.1 / np.sqrt(rank))
+            return {key + '_U': tf.Variable(tf.random.truncated_normal([n_in, rank], stddev=stddev)),
+                    key + '_V': tf.Variable(tf.random.truncated_normal([rank, n_out], stddev=stddev))}
+        if kind == 'blocksparse':
+            block_size, density = int(params[0]), float(params[1])
+            if n_in % block_size or n_out % block_size:
+                raise ValueError("Layer %s: %dx%d is not divisible into %d blocks" % (key, n_in, n_out, block_size))
+            n_in_blocks, n_out_blocks = n_in // block_size, n_out // block_size
+            n_kept = max(1, int(round(density * n_in_blocks)))
+            # A fixed (seeded) pattern, the same every time the network is built so checkpoints stay valid
+            rng = np.random.default_rng(seed)
+            index = np.stack([np.sort(rng.choice(n_in_blocks, n_kept, replace=False)) for _ in range(n_out_blocks)])
+            self.block_index[key] = (index.astype(np.int32), block_size)
+            return {key: tf.Variable(tf.random.truncated_normal([n_out_blocks, n_kept, block_size, block_size],
+                                                                stddev=0.1))}
+        raise ValueError("Unknown layer type: %s, use: %s" % (layer_type, ', '.join(LAYER_TYPES)))
+
     def getWeights(self) -> (dict, dict):
         # Store layers weight & bias
         weights = dict()
         biases = dict()
         last_output = self.input_num
-        for idx, hidden_layer in enumerate(self.hidden_layers):
-            weights['L' + str(idx)] = tf.Variable(tf.random.truncated_normal([last_output, hidden_layer], stddev=0.1))
+        for idx, (hidden_layer, layer_type) in enumerate(zip(self.hidden_layers, self.layer_types)):
+            layer_weights = self.getLayerWeights('L' + str(idx), last_output, hidden_layer, layer_type, idx)
+            weights.update(layer_weights)
             biases['L' + str(idx)] = tf.Variable(tf.constant(0.1, shape=[hidden_layer]))
             last_output = hidden_layer
 
-            tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, weights['L' + str(idx)])
-            tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, biases['L' + str(idx)])
+            # Graph collections only exist in graph mode, the eager training uses variables()
+            if not tf.executing_eagerly():
+                for weight in layer_weights.values():
+                    tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, weight)
+                tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, biases['L' + str(idx)])
 
         weights['out'] = tf.Variable(tf.random.truncated_normal([hidden_layer, self.class_num], stddev=0.1))
         biases['out'] = tf.Variable(tf.constant(0.1, shape=[self.class_num]))
 
-        tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, weights['out'])
-        tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, biases['out'])
+        if not tf.executing_eagerly():
+            tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, weights['out'])
+            tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, biases['out'])
         return weights, biases
 
+    def variables(self) -> list:
+        return list(self.weights.values()) + list(self.biases.values())
+
+    def paramCount(self) -> int:
+        return int(sum(np.prod(x.shape.as_list()) for x in self.variables()))
+
+    def layer(self, x, idx: int):
+        """
+        :return: The pre-activation output of hidden layer idx
+        """
+        key = 'L' + str(idx)
+        kind = self.layer_types[idx].split(':')[0]
+        if kind == 'lowrank':
+            # x.U first, the n_in x n_out product is never formed
+            out = tf.matmul(tf.matmul(x, self.weights[key + '_U']), self.weights[key + '_V'])
+        elif kind == 'blocksparse':
+            index, block_size = self.block_index[key]
+            x_blocks = tf.reshape(x, [tf.shape(x)[0], -1, block_size])
+            # (batch, out blocks, kept in blocks, block) x (out blocks, kept in blocks, block, block)
+            out = tf.einsum('nokb,okbc->noc', tf.gather(x_blocks, index, axis=1), self.weights[key])
+            out = tf.reshape(out, [-1, self.hidden_layers[idx]])
+        else:
+            out = tf.matmul(x, self.weights[key])
+        return tf.add(out, self.biases[key])
+
     # Define the neural network
     def getModel(self, x: np.ndarray):
-        global num_classes
         # Output fully connected layer with a neuron for each class
-        layers_keys = list(self.weights.keys())
-        Ls = [tf.matmul(x, self.weights[layers_keys[0]]) + self.biases[layers_keys[0]]]
-        relus = [tf.nn.relu(Ls[-1])]
-        for key in layers_keys[1:-1]:
-            newL = tf.add(tf.matmul(relus[-1], self.weights[key]), self.biases[key])
-            Ls.append(newL)
-            relus.append(tf.nn.sigmoid(newL))
+        relus = [tf.nn.relu(self.layer(x, 0))]
+        for idx in range(1, len(self.hidden_layers)):
+            relus.append(tf.nn.sigmoid(self.layer(relus[-1], idx)))
 
         out_layer = tf.add(tf.matmul(relus[-1], self.weights['out']), self.biases['out'])
 
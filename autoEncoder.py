@@ -14,23 +14,19 @@ from tensorflow.keras import layers
 
 from datetime import datetime
 
-from utils import prepareData
+from utils import prepareDataset
 
 
-def main():
-    DATA_DIR = "data/mini_data"
-    img_size = img_h = img_w = 64
-    train_x, test_x, train_y, test_y = \
-        prepareData(
-            img_folder=DATA_DIR,
-            img_size=img_size,
-            sample_size=-128,
-            normalize=True)
-    epoch = len(train_x)
-
+def buildModel(img_size: int, decay_steps: int) -> (keras.Model, keras.Model):
+    """
+    Builds the autoencoder, the full model is compiled to reconstruct its input
+    :param img_size: The input height/width
+    :param decay_steps: Steps between the learning rate decays
+    :return: The autoencoder, the encoder
+    """
     # Network construction
     #   Encoder
-    input_img = layers.Input(shape=(img_h, img_w, 1))
+    input_img = layers.Input(shape=(img_size, img_size, 1))
     x = layers.Conv2D(32, (5, 5), activation='relu', padding='same')(input_img)
     x = layers.Conv2D(32, (5, 5), activation='relu', padding='same')(x)
     x = layers.Conv2D(32, (5, 5), activation='relu', padding='same')(x)
@@ -66,13 +62,32 @@ def main():
     initial_learning_rate_main = 1e-4
     lr_schedule_main = keras.optimizers.schedules.ExponentialDecay(
         initial_learning_rate_main,
-        decay_steps=epoch * 5,
+        decay_steps=decay_steps,
         decay_rate=1e-1,
         staircase=True)
 
     decoder_model.compile(optimizer=keras.optimizers.Adam(learning_rate=lr_schedule_main),
                           loss=tf.keras.losses.mse
                           )
+    return decoder_model, encoder_model
+
+
+def main():
+    DATA_DIR = "data/mini_data"
+    img_size = img_h = img_w = 64
+    train_ds, test_ds, epoch = \
+        prepareDataset(
+            img_folder=DATA_DIR,
+            img_size=img_size,
+            sample_size=-128,
+            normalize=True,
+            batch_size=128)
+    # The autoencoder reconstructs its input
+    train_ds = train_ds.map(lambda x, y: (x, x))
+    test_ds = test_ds.map(lambda x, y: (x, x))
+    test_x = next(iter(test_ds))[0].numpy()
+
+    decoder_model, encoder_model = buildModel(img_size, decay_steps=epoch * 5)
 
     log_dir = os.path.join("tf_logs", "AE", datetime.now().strftime("%Y%m%d-%H%M%S/"))
     os.makedirs(os.path.join(log_dir, 'encoder'))
@@ -125,12 +140,9 @@ def main():
     # Define the per-epoch callback.
     cm_callback = keras.callbacks.LambdaCallback(on_epoch_end=log_img_pred)
 
-    decoder_model.fit(x=train_x,
-                      y=train_x,
-                      batch_size=128,
+    decoder_model.fit(train_ds,
                       epochs=200,
-                      use_multiprocessing=True,
-                      validation_data=(test_x, test_x),
+                      validation_data=test_ds,
                       callbacks=[tensorboard_callback,
                                  save_callback,
                                  save_encoder_callback,
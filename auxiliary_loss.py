@@ -14,24 +14,20 @@ from tensorflow.keras import layers
 
 from datetime import datetime
 
-from utils import prepareData
+from utils import listCategories, prepareDataset
 
 
-def main():
-    DATA_DIR = "data/mini_data"
-    CATEGORIES = os.listdir(DATA_DIR)
-    img_size = img_h = img_w = 64
-    train_x, test_x, train_y, test_y = \
-        prepareData(
-            img_folder=DATA_DIR,
-            img_size=img_size,
-            sample_size=-128,
-            normalize=True)
-    epoch = len(train_x)
-
+def buildModel(img_size: int, n_classes: int, decay_steps: int) -> (keras.Model, keras.Model):
+    """
+    Builds and compiles the classifier with the autoencoder auxiliary loss
+    :param img_size: The input height/width
+    :param n_classes: Number of categories
+    :param decay_steps: Steps between the learning rate decays
+    :return: The full model (main_output, decoder_output), the autoencoder
+    """
     # Network construction
     #   Encoder
-    input_img = layers.Input(shape=(img_h, img_w, 1))
+    input_img = layers.Input(shape=(img_size, img_size, 1))
     x = layers.Conv2D(32, (5, 5), activation='relu', padding='same')(input_img)
     x = layers.Conv2D(32, (5, 5), activation='relu', padding='same')(x)
     x = layers.Conv2D(32, (5, 5), activation='relu', padding='same')(x)
@@ -69,7 +65,7 @@ def main():
     x = layers.Dropout(0.4)(x)
 
     # Main output
-    main_output = layers.Dense(len(CATEGORIES),
+    main_output = layers.Dense(n_classes,
                                activation=tf.keras.activations.softmax,
                                name='main_output')(x)
 
@@ -79,7 +75,7 @@ def main():
     initial_learning_rate_main = 1e-4
     lr_schedule_main = keras.optimizers.schedules.ExponentialDecay(
         initial_learning_rate_main,
-        decay_steps=epoch * 5,
+        decay_steps=decay_steps,
         decay_rate=1e-1,
         staircase=True)
 
@@ -88,6 +84,26 @@ def main():
                   loss={'main_output': keras.losses.sparse_categorical_crossentropy,
                         'decoder_output': tf.keras.losses.mse},
                   loss_weights={'main_output': 1, 'decoder_output': 1})
+    return model, decoder_model
+
+
+def main():
+    DATA_DIR = "data/mini_data"
+    CATEGORIES = listCategories(DATA_DIR)
+    img_size = img_h = img_w = 64
+    train_ds, test_ds, epoch = \
+        prepareDataset(
+            img_folder=DATA_DIR,
+            img_size=img_size,
+            sample_size=-128,
+            normalize=True,
+            batch_size=128)
+    # Classification output plus the reconstruction of the input
+    train_ds = train_ds.map(lambda x, y: (x, {'main_output': y, 'decoder_output': x}))
+    test_ds = test_ds.map(lambda x, y: (x, {'main_output': y, 'decoder_output': x}))
+    test_x = next(iter(test_ds))[0].numpy()
+
+    model, decoder_model = buildModel(img_size, len(CATEGORIES), decay_steps=epoch * 5)
 
     log_dir = os.path.join("tf_logs", "AL", datetime.now().strftime("%Y%m%d-%H%M%S/"))
     os.makedirs(os.path.join(log_dir, 'encoder'))
@@ -124,12 +140,9 @@ def main():
     # Define the per-epoch callback.
     cm_callback = keras.callbacks.LambdaCallback(on_epoch_end=log_img_pred)
 
-    model.fit(x=train_x,
-              y=[train_y, train_x],
-              batch_size=128,
+    model.fit(train_ds,
               epochs=200,
-              use_multiprocessing=True,
-              validation_data=(test_x, [test_y, test_x]),
+              validation_data=test_ds,
               callbacks=[tensorboard_callback,
                          save_callback,
                          cm_callback
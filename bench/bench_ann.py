@@ -0,0 +1,142 @@
+"""
+Dense vs factorized (low-rank) vs block-sparse SimpleAnn hidden layers on a synthetic classification task:
+parameter count and size, peak memory, train step time and test accuracy of every layers spec.
+Every spec trains with the same data, steps and learning rate schedule (main.EagerTrainer, main.py --runtime eager),
+in its own process, so the peak memory is per spec.
+
+Usage (from the repository root):
+    python -m bench.bench_ann [--specs NAME=SPEC ...] [--n_train 4096] [--epochs 10] [--batch_size 128] [--jit]
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from bench.common import benchParser, peakRSS, printTable, tfDevices, writeResults
+
+SPECS = {
+    'dense': '16384,4096,4096,1024,256',
+    'lowrank': '16384:lowrank:128,4096:lowrank:128,4096:lowrank:128,1024,256',
+    'blocksparse': '16384:blocksparse:64:0.125,4096:blocksparse:64:0.125,4096:blocksparse:64:0.125,1024,256',
+    'mixed': '16384:lowrank:128,4096:blocksparse:64:0.125,4096:lowrank:128,1024,256',
+}
+N_CLASSES = 4
+RESULT_PREFIX = 'RESULT '
+
+
+def syntheticImages(n_samples: int, n_input: int, n_classes: int, spread: float, seed: int = 0) -> (np.ndarray,
+                                                                                                   np.ndarray):
+    """
+    Noisy copies of a random [0, 1] image per class
+    :return: The flattened images, the one-hot labels
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.random((n_classes, n_input), dtype=np.float32)
+    labels = rng.integers(0, n_classes, n_samples)
+    x = np.clip(centers[labels] + spread * rng.normal(size=(n_samples, n_input)).astype(np.float32), 0, 1)
+    return x, np.eye(n_classes, dtype=np.float32)[labels]
+
+
+def benchSpec(spec: str, args) -> dict:
+    import main
+
+    n_input = args.img_size ** 2
+    x, y = syntheticImages(args.n_train + args.n_test, n_input, N_CLASSES, args.spread)
+    train = main.Datapack(x[:args.n_train], y[:args.n_train])
+    test = main.Datapack(x[args.n_train:], y[args.n_train:])
+    steps_per_epoch = max(1, args.n_train // args.batch_size)
+
+    net = main.makeNet('ANN', n_input, N_CLASSES, spec)
+    trainer = main.EagerTrainer(net, steps_per_epoch * 40, args.jit)
+    batches = main.BatchPrefetcher(train, args.batch_size, seed=0)
+    step_times = list()
+    accuracy = list()
+    for _ in range(args.epochs):
+        for _ in range(steps_per_epoch):
+            batch_x, batch_y = batches.next_batch()
+            start_t = time.perf_counter()
+            trainer.train_step(batch_x, batch_y).numpy()
+            step_times.append(time.perf_counter() - start_t)
+        accuracy.append(trainer.evaluate(test, 1024)[0])
+    batches.close()
+
+    # The first epoch includes the tracing/compilation
+    timed = step_times[steps_per_epoch:] or step_times
+    reached = [i + 1 for i, acc in enumerate(accuracy) if acc >= args.target_acc]
+    n_params = net.paramCount()
+    return {'params': n_params, 'param_mb': n_params * 4 / 2 ** 20, 'step_ms': 1000 * float(np.mean(timed)),
+            'steps_per_s': 1 / float(np.mean(timed)), 'accuracy': accuracy[-1], 'epoch_accuracy': accuracy,
+            'epochs_to_target': reached[0] if reached else None}
+
+
+def runWorker(args):
+    name, _, spec = args.worker.partition('=')
+    result = {'name': name, 'spec': spec}
+    result.update(benchSpec(spec, args))
+    result['devices'] = tfDevices()
+    result['peak_rss_mb'] = peakRSS()
+    print(RESULT_PREFIX + json.dumps(result))
+
+
+def main(args):
+    specs = dict(x.split('=', 1) for x in args.specs) if args.specs else SPECS
+    results = list()
+    for name, spec in specs.items():
+        print("Benchmarking %s (%s).." % (name, spec))
+        cmd = [sys.executable, '-m', 'bench.bench_ann', '--worker', '%s=%s' % (name, spec)]
+        for flag in ('n_train', 'n_test', 'img_size', 'spread', 'epochs', 'batch_size', 'target_acc'):
+            cmd += ['--' + flag, str(getattr(args, flag))]
+        if args.jit:
+            cmd += ['--jit']
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        lines = [x for x in proc.stdout.splitlines() if x.startswith(RESULT_PREFIX)]
+        if proc.returncode != 0 or not lines:
+            print(proc.stderr[-2000:])
+            results.append({'name': name, 'spec': spec, 'error': (proc.stderr.strip().splitlines() or ['failed'])[-1]})
+            continue
+        results.append(json.loads(lines[-1][len(RESULT_PREFIX):]))
+
+    done = [x for x in results if 'error' not in x]
+    if done:
+        printTable(done, ['name', 'params', 'param_mb', 'peak_rss_mb', 'step_ms', 'steps_per_s', 'accuracy',
+                          'epochs_to_target'])
+    for failed in (x for x in results if 'error' in x):
+        print("%s failed: %s" % (failed['name'], failed['error']))
+    writeResults(args.out, 'bench_ann', {k: v for k, v in vars(args).items() if k not in ('out', 'worker')},
+                 results)
+
+
+if __name__ == '__main__':
+    parser = benchParser('Dense/low-rank/block-sparse ANN benchmark', 'bench_ann')
+    parser.add_argument('--specs', dest="specs", type=str, nargs='+',
+                        help=('NAME=SPEC hidden layer specs to compare (see main.py --ann_layers), default: %s'
+                              % ' '.join('%s=%s' % x for x in SPECS.items())))
+    parser.add_argument('--n_train', dest="n_train", type=int, default=4096,
+                        help='Number of synthetic training samples')
+    parser.add_argument('--n_test', dest="n_test", type=int, default=1024,
+                        help='Number of synthetic test samples')
+    parser.add_argument('--img_size', dest="img_size", type=int, default=32,
+                        help='Input height/width, as main.py')
+    parser.add_argument('--spread', dest="spread", type=float, default=1.,
+                        help='Noise stddev around the class images, higher is harder')
+    parser.add_argument('--epochs', dest="epochs", type=int, default=10,
+                        help='Number of training epochs')
+    parser.add_argument('--batch_size', dest="batch_size", type=int, default=128,
+                        help='Mini batch size')
+    parser.add_argument('--target_acc', dest="target_acc", type=float, default=.9,
+                        help='Test accuracy for the epochs_to_target column')
+    parser.add_argument('--jit', dest="jit", action='store_true',
+                        help='Compile the train/eval steps with XLA')
+    parser.add_argument('--worker', dest="worker", type=str,
+                        help=('Runs a single NAME=SPEC in this process and prints its result, '
+                              'used by the benchmark for the per spec processes'))
+
+    args = parser.parse_args()
+    if args.worker:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+        runWorker(args)
+    else:
+        main(args)
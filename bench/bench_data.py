@@ -0,0 +1,220 @@
+"""
+Data loading benchmark: generates a synthetic image folder (and a train.csv with RLE masks) and times
+utils.prepareData, utils.prepareSegData and main.loadData (with the dataset cache off), with a per-stage breakdown
+(listdir, read_csv, imread, resize, RLE decode, stacking, split) and the images/sec at different worker counts.
+The stages are measured by timing the functions the loaders call, in a single process run.
+
+Usage (from the repository root):
+    python -m bench.bench_data [--n_per_class 200] [--n_seg_images 40] [--workers 1 2 4]
+"""
+import collections
+import os
+import shutil
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+
+import utils
+from bench.common import Timer, benchParser, printTable, writeResults
+
+CATEGORIES = list(utils.SEG_CATEGORIES)
+
+
+def syntheticImage(rng: np.random.Generator, height: int, width: int, channels: int = 1) -> np.ndarray:
+    """
+    Smooth noise (upscaled low resolution noise), compresses like a cloud photo rather than like white noise
+    """
+    small = rng.integers(0, 256, (max(1, height // 16), max(1, width // 16), channels), dtype=np.uint8)
+    img = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    return img.reshape(height, width, channels)
+
+
+def makeClassFolder(folder: str, n_per_class: int, crop_size: int, seed: int = 0):
+    """
+    A folder per category with n_per_class grayscale png crops, the data_gen output layout
+    """
+    rng = np.random.default_rng(seed)
+    for cat in CATEGORIES:
+        os.makedirs(os.path.join(folder, cat), exist_ok=True)
+        for i in range(n_per_class):
+            cv2.imwrite(os.path.join(folder, cat, '%05d.png' % i), syntheticImage(rng, crop_size, crop_size))
+
+
+def makeSegFolder(folder: str, csv_path: str, n_images: int, width: int, height: int, seed: int = 0):
+    """
+    n_images color jpg images and a train.csv with an RLE mask (a few rectangles) per category and image,
+    about a third of the masks are empty like in the original data
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    rows = list()
+    for i in range(n_images):
+        img_name = '%07x.jpg' % i
+        cv2.imwrite(os.path.join(folder, img_name), syntheticImage(rng, height, width, 3))
+        for cat in CATEGORIES:
+            mask = np.zeros((height, width), dtype=np.uint8)
+            if rng.random() > 1 / 3:
+                for _ in range(rng.integers(1, 4)):
+                    y0, x0 = rng.integers(0, height // 2), rng.integers(0, width // 2)
+                    mask[y0:y0 + rng.integers(height // 8, height // 2), x0:x0 + rng.integers(width // 8, width // 2)] = 1
+            rle = utils.mask_to_rle(mask)
+            rows.append((img_name + '_' + cat, rle if rle else np.nan))
+    pd.DataFrame(rows, columns=['Image_Label', 'EncodedPixels']).to_csv(csv_path, index=False)
+
+
+class StageProfiler(object):
+    """
+    Sums the wall time spent in wrapped functions, per stage, while in a with block:
+        with StageProfiler() as prof:
+            prof.wrap(cv2, 'imread', 'imread')
+            ...
+    The wrapped functions are restored on exit. Only calls made in this process are timed.
+    """
+
+    def __init__(self):
+        self.times = collections.OrderedDict()
+        self._patches = list()
+
+    def wrap(self, module, name: str, stage: str):
+        func = getattr(module, name)
+        self.times.setdefault(stage, 0.)
+
+        def timed(*args, **kwargs):
+            start_t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.times[stage] += time.perf_counter() - start_t
+
+        setattr(module, name, timed)
+        self._patches.append((module, name, func))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for module, name, func in reversed(self._patches):
+            setattr(module, name, func)
+        self._patches = list()
+        return False
+
+
+def stageResult(loader: str, n_workers: int, n_images: int, total: float, stages: dict = None) -> dict:
+    result = {'loader': loader, 'n_workers': n_workers, 'n_images': n_images, 'total_s': total,
+              'images_per_s': n_images / total}
+    if stages is not None:
+        # Whatever is not in a wrapped function: the array stacking/copies, normalization and bookkeeping
+        stages['stack/other'] = max(0., total - sum(stages.values()))
+        result['stages'] = {k: round(v, 4) for k, v in stages.items()}
+    return result
+
+
+def benchPrepareData(class_dir: str, img_size: int, workers: list) -> list:
+    results = list()
+    n_images = len(utils.listImages(class_dir, 1 << 30)[0])
+    for n_workers in workers:
+        with StageProfiler() as prof:
+            if n_workers == 1:
+                prof.wrap(utils, 'listImages', 'listdir')
+                prof.wrap(cv2, 'imread', 'imread')
+                prof.wrap(cv2, 'resize', 'resize')
+                prof.wrap(utils, 'NOT_SK_LEARN_train_test_split', 'split')
+            with Timer() as t:
+                utils.prepareData(class_dir, img_size, sample_size=1 << 30, normalize=True, n_workers=n_workers,
+                                  cache_dir=None)
+        results.append(stageResult('prepareData', n_workers, n_images, t.elapsed,
+                                   dict(prof.times) if n_workers == 1 else None))
+    return results
+
+
+def benchPrepareSegData(seg_dir: str, csv_path: str, img_size: int) -> list:
+    n_images = len(os.listdir(seg_dir))
+    with StageProfiler() as prof:
+        prof.wrap(pd, 'read_csv', 'read_csv')
+        prof.wrap(cv2, 'imread', 'imread')
+        prof.wrap(cv2, 'resize', 'resize')
+        prof.wrap(utils, 'rle_to_mask', 'rle_decode')
+        prof.wrap(utils, 'NOT_SK_LEARN_train_test_split', 'split')
+        with Timer() as t:
+            utils.prepareSegData(csv_path, seg_dir, img_size, sample_size=1 << 30, normalize=True)
+    return [stageResult('prepareSegData', 1, n_images, t.elapsed, dict(prof.times))]
+
+
+def benchLoadData(class_dir: str, img_size: int, workers: list) -> list:
+    try:
+        import main
+    except ImportError as e:
+        print("Skipping loadData: %s" % e)
+        return [{'loader': 'loadData', 'error': str(e)}]
+
+    results = list()
+    for n_workers in workers:
+        with StageProfiler() as prof:
+            if n_workers == 1:
+                prof.wrap(main, 'listCategoryImages', 'listdir')
+                prof.wrap(cv2, 'imread', 'imread')
+                prof.wrap(cv2, 'resize', 'resize')
+                prof.wrap(main, 'splitData', 'split')
+            with Timer() as t:
+                data, _ = main.loadData(class_dir, img_size=img_size, cache_dir=None, n_workers=n_workers)
+                main.splitData(data)
+        results.append(stageResult('loadData', n_workers, len(data), t.elapsed,
+                                   dict(prof.times) if n_workers == 1 else None))
+    return results
+
+
+def main(args):
+    work_dir = args.data_dir or tempfile.mkdtemp(prefix='bench_data_')
+    class_dir = os.path.join(work_dir, 'mini_data')
+    seg_dir = os.path.join(work_dir, 'train_images')
+    csv_path = os.path.join(work_dir, 'train.csv')
+    try:
+        if not os.path.isdir(class_dir):
+            print("Generating %d crops per category in %s.." % (args.n_per_class, class_dir))
+            makeClassFolder(class_dir, args.n_per_class, args.crop_size)
+        if not os.path.isfile(csv_path):
+            print("Generating %d %dx%d images with masks in %s.." % (args.n_seg_images, args.width, args.height,
+                                                                     seg_dir))
+            makeSegFolder(seg_dir, csv_path, args.n_seg_images, args.width, args.height)
+
+        results = benchPrepareData(class_dir, args.img_size, args.workers)
+        results += benchPrepareSegData(seg_dir, csv_path, args.seg_img_size)
+        results += benchLoadData(class_dir, args.img_size, args.workers)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    done = [x for x in results if 'error' not in x]
+    printTable(done, ['loader', 'n_workers', 'n_images', 'total_s', 'images_per_s'])
+    for result in done:
+        if 'stages' in result:
+            print('%s stages: %s' % (result['loader'], ', '.join(
+                '%s %.3fs (%.0f%%)' % (k, v, 100 * v / result['total_s']) for k, v in result['stages'].items())))
+    writeResults(args.out, 'bench_data', {k: v for k, v in vars(args).items() if k != 'out'}, results)
+
+
+if __name__ == '__main__':
+    parser = benchParser('Data loading benchmark', 'bench_data')
+    parser.add_argument('--data_dir', dest="data_dir", type=str,
+                        help='Keep the synthetic data in this folder (reused if it exists), a temporary folder if not set')
+    parser.add_argument('--n_per_class', dest="n_per_class", type=int, default=200,
+                        help='Number of crops per category')
+    parser.add_argument('--crop_size', dest="crop_size", type=int, default=350,
+                        help='Height/width of the crops')
+    parser.add_argument('--n_seg_images', dest="n_seg_images", type=int, default=40,
+                        help='Number of segmentation images')
+    parser.add_argument('--width', dest="width", type=int, default=2100,
+                        help='Width of the segmentation images')
+    parser.add_argument('--height', dest="height", type=int, default=1400,
+                        help='Height of the segmentation images')
+    parser.add_argument('--img_size', dest="img_size", type=int, default=32,
+                        help='Output size of prepareData/loadData')
+    parser.add_argument('--seg_img_size', dest="seg_img_size", type=int, default=128,
+                        help='Output size of prepareSegData')
+    parser.add_argument('--workers', dest="workers", type=int, nargs='+', default=[1, 2, 4],
+                        help='Worker counts to compare, the stages are measured with 1 worker')
+
+    main(parser.parse_args())
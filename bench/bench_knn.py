@@ -0,0 +1,86 @@
+"""
+KNN reference set storage benchmark: memory, fit/search speed and accuracy of the float32, float16 and int8
+embeddings on synthetic clustered embeddings.
+
+Usage (from the repository root):
+    python -m bench.bench_knn [--n_train 50000] [--n_test 2000] [--dim 256] [--index exact|ivf]
+"""
+import numpy as np
+
+from bench.common import Timer, benchParser, printTable, writeResults
+from classify_knn import NOT_SKLEARN_KNN, makeIndex
+
+
+def syntheticEmbeddings(n_train: int, n_test: int, dim: int, n_classes: int, spread: float,
+                        seed: int = 0) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    """
+    Gaussian blobs around a random center per class, non-negative like the encoder (relu) outputs
+    :return: train_x, test_x, train_y, test_y
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_classes, dim)).astype(np.float32)
+    labels = rng.integers(0, n_classes, n_train + n_test)
+    vecs = np.maximum(centers[labels] + spread * rng.normal(size=(len(labels), dim)).astype(np.float32), 0)
+    return vecs[:n_train], vecs[n_train:], labels[:n_train], labels[n_train:]
+
+
+def main(args):
+    train_x, test_x, train_y, test_y = syntheticEmbeddings(args.n_train, args.n_test, args.dim, args.n_classes,
+                                                           args.spread)
+    results = list()
+    base_pred = base_nn = None
+    for storage in args.storages:
+        knn = NOT_SKLEARN_KNN(args.k, args.chunk_size, makeIndex(args.index, args.n_lists, args.n_probe),
+                              storage=storage)
+        with Timer() as fit_t:
+            knn.fit(train_x, train_y)
+        with Timer() as search_t:
+            nn_idxs = knn.kneighbors(test_x)
+        pred = knn.predict(test_x)
+        if base_pred is None:
+            base_pred, base_nn = pred, nn_idxs
+
+        accuracy = float((pred == test_y).mean())
+        results.append({
+            'storage': storage,
+            'data_mb': knn.data.nbytes / (1 << 20),
+            'fit_s': fit_t.elapsed,
+            'search_s': search_t.elapsed,
+            'queries_per_s': len(test_x) / search_t.elapsed,
+            'accuracy': accuracy,
+            'accuracy_delta': accuracy - results[0]['accuracy'] if results else 0.,
+            'same_pred': float((pred == base_pred).mean()),
+            'nn_overlap': float(np.mean([len(np.intersect1d(a, b)) for a, b in zip(nn_idxs, base_nn)]) / args.k),
+        })
+
+    printTable(results, ['storage', 'data_mb', 'fit_s', 'search_s', 'queries_per_s', 'accuracy', 'accuracy_delta',
+                         'same_pred', 'nn_overlap'])
+    writeResults(args.out, 'bench_knn', {k: v for k, v in vars(args).items() if k != 'out'}, results)
+
+
+if __name__ == '__main__':
+    parser = benchParser('KNN embeddings storage benchmark', 'bench_knn')
+    parser.add_argument('--n_train', dest="n_train", type=int, default=50000,
+                        help='Number of reference embeddings')
+    parser.add_argument('--n_test', dest="n_test", type=int, default=2000,
+                        help='Number of queries')
+    parser.add_argument('--dim', dest="dim", type=int, default=256,
+                        help='Embeddings size')
+    parser.add_argument('--n_classes', dest="n_classes", type=int, default=4,
+                        help='Number of categories')
+    parser.add_argument('--spread', dest="spread", type=float, default=2.,
+                        help='Std of the embeddings around their category center, higher makes it harder')
+    parser.add_argument('--k', dest="k", type=int, default=5,
+                        help='Number of neighbors')
+    parser.add_argument('--chunk_size', dest="chunk_size", type=int, default=1024,
+                        help='Queries per distances matrix')
+    parser.add_argument('--index', dest="index", type=str, default='exact',
+                        help='Nearest neighbors search: exact or ivf')
+    parser.add_argument('--n_lists', dest="n_lists", type=int, default=64,
+                        help='Number of clusters of the ivf index')
+    parser.add_argument('--n_probe', dest="n_probe", type=int, default=8,
+                        help='Number of clusters the ivf index searches')
+    parser.add_argument('--storages', dest="storages", type=str, nargs='+', default=['float32', 'float16', 'int8'],
+                        help='Storage types to compare, the first one is the accuracy baseline')
+
+    main(parser.parse_args())
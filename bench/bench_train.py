@@ -0,0 +1,251 @@
+"""
+Training/inference throughput of the models on synthetic data: the SLP/ANN of main.py (session or tf.function), the CNN,
+the segNet encoder-decoder, the autoencoder and the auxiliary loss model.
+Every model runs in its own process, so the peak memory is per model.
+
+Usage (from the repository root):
+    python -m bench.bench_train [--models SLP ANN CNN SEG AE AUX] [--n_samples 512] [--epochs 3]
+                                [--img_size SIZE] [--batch_size BATCH] [--runtime graph|eager] [--jit]
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from bench.common import benchParser, peakRSS, printTable, tfDevices, writeResults
+
+# Input size and batch size of every model in its training script
+MODELS = {'SLP': (32, 128), 'ANN': (32, 128), 'CNN': (256, 256), 'SEG': (128, 64), 'AE': (64, 128), 'AUX': (64, 128)}
+N_CLASSES = 4
+RESULT_PREFIX = 'RESULT '
+
+
+def throughput(epoch_times: list, steps_per_epoch: int, n_samples: int) -> dict:
+    """
+    :return: The training throughput, the first epoch (graph building/tracing) is left out when there are more
+    """
+    timed = epoch_times[1:] if len(epoch_times) > 1 else epoch_times
+    total = sum(timed)
+    return {'epoch_s': epoch_times,
+            'steps_per_s': steps_per_epoch * len(timed) / total,
+            'images_per_s': n_samples * len(timed) / total}
+
+
+def benchGraph(name: str, n_samples: int, img_size: int, batch_size: int, epochs: int,
+               input_mode: str = 'feed') -> dict:
+    """
+    Trains the SLP/ANN graph of main.py as main.build_and_run does, with feed_dict batches or with the
+    train set staged into the graph (input_mode graph)
+    """
+    import tensorflow.compat.v1 as tf
+    import main
+
+    tf.disable_v2_behavior()
+    n_input = img_size ** 2
+    rng = np.random.default_rng(0)
+    x = rng.random((n_samples, n_input), dtype=np.float32)
+    y = np.eye(N_CLASSES, dtype=np.float32)[rng.integers(0, N_CLASSES, n_samples)]
+    # At least a step, a batch larger than the samples trains on all of them
+    steps_per_epoch = max(1, n_samples // batch_size)
+
+    with tf.Graph().as_default():
+        inputs = None
+        if input_mode == 'graph':
+            batch_x, batch_y, stage_op, stage_feed = main.graphBatches(main.Datapack(x, y), batch_size)
+            inputs = (batch_x, batch_y)
+        graph = main.buildGraph(main.makeNet(name, n_input, N_CLASSES).getModel, n_input, N_CLASSES,
+                                decay_steps=steps_per_epoch * 40, inputs=inputs)
+        n_params = int(sum(np.prod(v.shape.as_list()) for v in tf.trainable_variables()))
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            if input_mode == 'graph':
+                sess.run(stage_op, feed_dict=stage_feed)
+            epoch_times = list()
+            for _ in range(epochs):
+                start_t = time.perf_counter()
+                for step in range(steps_per_epoch):
+                    if input_mode == 'graph':
+                        sess.run(graph.train_op)
+                        continue
+                    batch = slice(step * batch_size, (step + 1) * batch_size)
+                    sess.run(graph.train_op, feed_dict={graph.X: x[batch], graph.Y: y[batch]})
+                epoch_times.append(time.perf_counter() - start_t)
+
+            start_t = time.perf_counter()
+            for start in range(0, n_samples, batch_size):
+                sess.run(graph.pred, feed_dict={graph.X: x[start:start + batch_size]})
+            infer_t = time.perf_counter() - start_t
+
+    result = throughput(epoch_times, steps_per_epoch, min(n_samples, steps_per_epoch * batch_size))
+    result.update({'params': n_params, 'infer_images_per_s': n_samples / infer_t})
+    return result
+
+
+def benchEager(name: str, n_samples: int, img_size: int, batch_size: int, epochs: int,
+               input_mode: str = 'feed', jit: bool = False) -> dict:
+    """
+    Trains the SLP/ANN with the tf.function steps of main.EagerTrainer (main.py --runtime eager)
+    """
+    import main
+
+    n_input = img_size ** 2
+    rng = np.random.default_rng(0)
+    x = rng.random((n_samples, n_input), dtype=np.float32)
+    y = np.eye(N_CLASSES, dtype=np.float32)[rng.integers(0, N_CLASSES, n_samples)]
+    steps_per_epoch = max(1, n_samples // batch_size)
+
+    trainer = main.EagerTrainer(main.makeNet(name, n_input, N_CLASSES), steps_per_epoch * 40, jit)
+    n_params = int(sum(np.prod(v.shape.as_list()) for v in trainer.variables))
+    rows = trainer.stage(main.Datapack(x, y), batch_size) if input_mode == 'graph' else None
+    epoch_times = list()
+    for _ in range(epochs):
+        start_t = time.perf_counter()
+        for step in range(steps_per_epoch):
+            if input_mode == 'graph':
+                loss = trainer.train_rows(next(rows))
+                continue
+            batch = slice(step * batch_size, (step + 1) * batch_size)
+            loss = trainer.train_step(x[batch], y[batch])
+        # The steps run asynchronously, wait for the last one
+        loss.numpy()
+        epoch_times.append(time.perf_counter() - start_t)
+
+    start_t = time.perf_counter()
+    trainer.evaluate(main.Datapack(x, y), batch_size)
+    infer_t = time.perf_counter() - start_t
+
+    result = throughput(epoch_times, steps_per_epoch, min(n_samples, steps_per_epoch * batch_size))
+    result.update({'params': n_params, 'infer_images_per_s': n_samples / infer_t})
+    return result
+
+
+def benchKeras(name: str, n_samples: int, img_size: int, batch_size: int, epochs: int) -> dict:
+    """
+    Trains a Keras model with model.fit on in-memory synthetic data
+    """
+    from tensorflow import keras
+
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, N_CLASSES, n_samples)
+    steps_per_epoch = int(np.ceil(n_samples / batch_size))
+    decay_steps = steps_per_epoch * 5
+    if name == 'CNN':
+        import CNN
+        model = CNN.buildModel(img_size, N_CLASSES, decay_steps)
+        x = rng.random((n_samples, img_size, img_size, 1), dtype=np.float32)
+        y = labels
+    elif name == 'SEG':
+        import segNet
+        model = segNet.buildModel(img_size, N_CLASSES, decay_steps)
+        x = rng.random((n_samples, img_size, img_size, 3), dtype=np.float32)
+        y = (rng.random((n_samples, img_size, img_size, N_CLASSES)) > .5).astype(np.float32)
+    elif name == 'AE':
+        import autoEncoder
+        model, _ = autoEncoder.buildModel(img_size, decay_steps)
+        x = rng.random((n_samples, img_size, img_size, 1), dtype=np.float32)
+        y = x
+    else:
+        import auxiliary_loss
+        model, _ = auxiliary_loss.buildModel(img_size, N_CLASSES, decay_steps)
+        x = rng.random((n_samples, img_size, img_size, 1), dtype=np.float32)
+        y = {'main_output': labels, 'decoder_output': x}
+
+    epoch_times = list()
+    epoch_start = dict()
+    timer = keras.callbacks.LambdaCallback(
+        on_epoch_begin=lambda epoch, logs: epoch_start.update(t=time.perf_counter()),
+        on_epoch_end=lambda epoch, logs: epoch_times.append(time.perf_counter() - epoch_start['t']))
+    model.fit(x, y, batch_size=batch_size, epochs=epochs, callbacks=[timer], verbose=0)
+
+    start_t = time.perf_counter()
+    model.predict(x, batch_size=batch_size)
+    infer_t = time.perf_counter() - start_t
+
+    result = throughput(epoch_times, steps_per_epoch, n_samples)
+    result.update({'params': int(model.count_params()), 'infer_images_per_s': n_samples / infer_t})
+    return result
+
+
+def runWorker(args):
+    img_size, batch_size = MODELS[args.worker]
+    img_size = args.img_size or img_size
+    batch_size = args.batch_size or batch_size
+    result = {'model': args.worker, 'img_size': img_size, 'batch_size': batch_size}
+    if args.worker in ('SLP', 'ANN'):
+        result.update({'runtime': args.runtime + ('+jit' if args.jit else ''), 'input_mode': args.input_mode})
+        if args.runtime == 'eager':
+            result.update(benchEager(args.worker, args.n_samples, img_size, batch_size, args.epochs,
+                                     args.input_mode, args.jit))
+        else:
+            result.update(benchGraph(args.worker, args.n_samples, img_size, batch_size, args.epochs,
+                                     args.input_mode))
+    else:
+        result.update(benchKeras(args.worker, args.n_samples, img_size, batch_size, args.epochs))
+    result['devices'] = tfDevices()
+    result['peak_rss_mb'] = peakRSS()
+    print(RESULT_PREFIX + json.dumps(result))
+
+
+def main(args):
+    results = list()
+    for name in args.models:
+        print("Benchmarking %s.." % name)
+        cmd = [sys.executable, '-m', 'bench.bench_train', '--worker', name,
+               '--n_samples', str(args.n_samples), '--epochs', str(args.epochs), '--input_mode', args.input_mode,
+               '--runtime', args.runtime]
+        if args.jit:
+            cmd += ['--jit']
+        if args.img_size:
+            cmd += ['--img_size', str(args.img_size)]
+        if args.batch_size:
+            cmd += ['--batch_size', str(args.batch_size)]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        lines = [x for x in proc.stdout.splitlines() if x.startswith(RESULT_PREFIX)]
+        if proc.returncode != 0 or not lines:
+            print(proc.stderr[-2000:])
+            results.append({'model': name, 'error': (proc.stderr.strip().splitlines() or ['failed'])[-1]})
+            continue
+        results.append(json.loads(lines[-1][len(RESULT_PREFIX):]))
+
+    done = [x for x in results if 'error' not in x]
+    if done:
+        printTable(done, ['model', 'img_size', 'batch_size', 'params', 'steps_per_s', 'images_per_s',
+                          'infer_images_per_s', 'peak_rss_mb'])
+    for failed in (x for x in results if 'error' in x):
+        print("%s failed: %s" % (failed['model'], failed['error']))
+    writeResults(args.out, 'bench_train', {k: v for k, v in vars(args).items() if k not in ('out', 'worker')},
+                 results)
+
+
+if __name__ == '__main__':
+    parser = benchParser('Training throughput benchmark', 'bench_train')
+    parser.add_argument('--models', dest="models", type=str, nargs='+', default=list(MODELS),
+                        help='Models to benchmark: %s' % ' '.join(MODELS))
+    parser.add_argument('--n_samples', dest="n_samples", type=int, default=512,
+                        help='Number of synthetic training samples')
+    parser.add_argument('--epochs', dest="epochs", type=int, default=3,
+                        help='Number of epochs, the first one is not counted in the throughput')
+    parser.add_argument('--img_size', dest="img_size", type=int,
+                        help='Input height/width (default: the size each training script uses)')
+    parser.add_argument('--batch_size', dest="batch_size", type=int,
+                        help='Batch size (default: the batch size each training script uses)')
+    parser.add_argument('--input_mode', dest="input_mode", type=str, default='feed', choices=['feed', 'graph'],
+                        help='Input of the SLP/ANN graphs: feed_dict batches or the data staged into the graph')
+    parser.add_argument('--runtime', dest="runtime", type=str, default='graph', choices=['graph', 'eager'],
+                        help='Runtime of the SLP/ANN: TF1 style session or the TF2 tf.function steps')
+    parser.add_argument('--jit', dest="jit", action='store_true',
+                        help='Compile the eager SLP/ANN steps with XLA')
+    parser.add_argument('--worker', dest="worker", type=str,
+                        help=('Runs a single model in this process and prints its result, '
+                              'used by the benchmark for the per model processes'))
+
+    args = parser.parse_args()
+    if args.worker:
+        # CPU measurements, the GPUs are hidden before TF is imported (as the training scripts do)
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+        runWorker(args)
+    else:
+        main(args)
@@ -0,0 +1,87 @@
+""" Helpers shared by the benchmarks: timing, peak memory and the JSON results file. """
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+
+def peakRSS() -> float:
+    """
+    :return: The peak resident memory of this process, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def tfDevices() -> list:
+    """
+    :return: The devices TF can run on in this process, recorded with the results of the TF benchmarks
+    """
+    import tensorflow as tf
+    return [x.name for x in tf.config.list_logical_devices()]
+
+
+class Timer(object):
+    """
+    Measures the wall time of a with block:
+        with Timer() as t:
+            ...
+        print(t.elapsed)
+    """
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.elapsed = 0.
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        return False
+
+
+def benchParser(description: str, name: str) -> argparse.ArgumentParser:
+    """
+    :return: A parser with the common benchmark options (--out)
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--out', dest="out", type=str, default=os.path.join('bench', 'results', name + '.json'),
+                        help='Where to write the JSON results')
+    return parser
+
+
+def writeResults(path: str, name: str, params: dict, results: list):
+    """
+    Writes the results of a benchmark run with the machine details, so runs can be compared over time
+    :param path: The JSON file
+    :param name: The benchmark name
+    :param params: The benchmark parameters
+    :param results: One dict per measured configuration
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    report = {'benchmark': name,
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                          'numpy': np.__version__, 'cpus': os.cpu_count()},
+              'params': params,
+              'peak_rss_mb': peakRSS(),
+              'results': results}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s" % path)
+
+
+def printTable(results: list, columns: list):
+    """
+    Prints the results as an aligned table
+    """
+    rows = [[('%.4g' % r[c]) if isinstance(r[c], float) else str(r[c]) for c in columns] for r in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(x.rjust(w) for x, w in zip(row, widths)))
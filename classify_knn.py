@@ -1,64 +1,835 @@
 import argparse
+import hashlib
+import json
 import os
 import sys
+from multiprocessing import Pool
 
 import tensorflow.keras as keras
 import numpy as np
 
-from utils import prepareData
+from utils import SHARD_SEP, NOT_SK_LEARN_train_test_split, cacheKey, decodeImages, listImages
+
+
+def sqDistances(queries: np.ndarray, data: np.ndarray, data_sq: np.ndarray, block_size: int = 16384) -> np.ndarray:
+    """
+    Squared euclidean distances up to a per-query constant:
+    ||a - b||^2 = ||a||^2 - 2ab + ||b||^2, ||a||^2 is the same for a whole row so it is left out
+    :param queries: (N, D) queries
+    :param data: (M, D) vectors, compact (float16/int8) vectors are converted block_size rows at a time
+    :param data_sq: (M,) squared norms of the vectors
+    :return: (N, M) distances
+    """
+    if data.dtype == queries.dtype:
+        return data_sq[np.newaxis, :] - 2 * queries @ data.T
+    dists = np.empty((len(queries), len(data)), dtype=queries.dtype)
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size].astype(queries.dtype)
+        dists[:, start:start + len(block)] = data_sq[np.newaxis, start:start + len(block)] - 2 * queries @ block.T
+    return dists
+
+
+def topK(dists: np.ndarray, ids: np.ndarray, k: int) -> (np.ndarray, np.ndarray):
+    """
+    Keeps the k smallest distances of each row (not sorted)
+    :param dists: (N, M) distances
+    :param ids: (N, M) or (M,) ids of the distances columns
+    :return: (N, k) distances, (N, k) ids
+    """
+    if dists.shape[1] > k:
+        keep = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        ids = np.broadcast_to(ids, dists.shape)
+        return np.take_along_axis(dists, keep, axis=1), np.take_along_axis(ids, keep, axis=1)
+    return dists, np.broadcast_to(ids, dists.shape)
+
+
+def growBuffer(buf: np.ndarray, size: int) -> np.ndarray:
+    """
+    Makes sure a buffer has room for size rows, a full buffer is copied to one of (at least) double
+    the capacity, so appending row by row costs amortized O(1) per row. A read-only buffer
+    (e.g. a memmap of a saved model) is copied too.
+    :param buf: The buffer
+    :param size: The needed number of rows
+    :return: The buffer, or a bigger copy of it
+    """
+    if len(buf) >= size and buf.flags.writeable:
+        return buf
+    new_buf = np.empty((max(size, 2 * len(buf)),) + buf.shape[1:], dtype=buf.dtype)
+    new_buf[:len(buf)] = buf
+    return new_buf
+
+
+class Quantizer(object):
+    """
+    Storage type of the embeddings: float32, float16 (half the memory) or int8 (a quarter), an int8 code
+    stands for code * scale + offset with a per-dimension scale and offset.
+    The distances are computed against the codes: a . (c * scale + offset) = (a * scale) . c + a . offset,
+    and a . offset is a per-query constant, so the queries are only scaled.
+    """
+    DTYPES = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
+
+    def __init__(self, dtype: str = 'float32', scale: np.ndarray = None, offset: np.ndarray = None):
+        if dtype not in self.DTYPES:
+            sys.exit("Error: Unknown storage %s, use: [%s]" % (dtype, ','.join(self.DTYPES)))
+        self.dtype = dtype
+        self.scale = scale
+        self.offset = offset
+
+    def fit(self, data: np.ndarray):
+        """
+        Fits the int8 range of every dimension to the data (vectors outside of it are clipped, see extend)
+        """
+        if self.dtype != 'int8':
+            return
+        self._setRange(data.min(axis=0), data.max(axis=0))
+
+    def _setRange(self, low: np.ndarray, high: np.ndarray):
+        self.offset = ((low + high) / 2).astype(np.float32)
+        self.scale = np.where(high > low, (high - low) / 255, 1).astype(np.float32)
+
+    def extend(self, data: np.ndarray, margin: float = .25) -> bool:
+        """
+        Widens the int8 range of the dimensions the data exceeds, by an extra margin of the new range
+        so that a slowly drifting stream does not widen it on every batch. The stored codes must then be
+        re-encoded (see reencode).
+        :return: True if the range changed
+        """
+        if self.dtype != 'int8':
+            return False
+        low, high = self.offset - 127.5 * self.scale, self.offset + 127.5 * self.scale
+        data_low, data_high = data.min(axis=0), data.max(axis=0)
+        below, above = data_low < low, data_high > high
+        if not (below.any() or above.any()):
+            return False
+        new_low, new_high = np.minimum(low, data_low), np.maximum(high, data_high)
+        pad = margin * (new_high - new_low)
+        self._setRange(np.where(below, new_low - pad, low), np.where(above, new_high + pad, high))
+        return True
+
+    def reencode(self, codes: np.ndarray, old: 'Quantizer', block_size: int = 16384):
+        """
+        Re-encodes, in place, codes of the old quantizer with this one
+        """
+        for start in range(0, len(codes), block_size):
+            codes[start:start + block_size] = self.encode(old.decode(codes[start:start + block_size]))
+
+    def encode(self, data: np.ndarray) -> np.ndarray:
+        if self.dtype == 'int8':
+            return np.clip(np.rint((data - self.offset) / self.scale), -128, 127).astype(np.int8)
+        return data.astype(self.DTYPES[self.dtype], copy=False)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        if self.dtype == 'int8':
+            return codes * self.scale + self.offset
+        return codes.astype(np.float32, copy=False)
+
+    def scaleQueries(self, queries: np.ndarray) -> np.ndarray:
+        return queries * self.scale if self.dtype == 'int8' else queries
+
+    def sqNorms(self, codes: np.ndarray, block_size: int = 16384) -> np.ndarray:
+        """
+        :return: The squared norms of the decoded vectors, for int8 codes without the ||offset||^2 term
+                 that is the same for all the vectors
+        """
+        sq = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), block_size):
+            block = codes[start:start + block_size]
+            if self.dtype == 'int8':
+                block = block * self.scale
+                sq[start:start + len(block)] = (block * (block + 2 * self.offset)).sum(axis=1)
+            else:
+                sq[start:start + len(block)] = (block.astype(np.float32) ** 2).sum(axis=1)
+        return sq
+
+    def getState(self) -> dict:
+        return {'scale': self.scale, 'offset': self.offset} if self.dtype == 'int8' else dict()
+
+
+class VectorIndex(object):
+    """
+    Base of the search indexes, keeps the data (the quantizer codes) and the squared norms of its vectors
+    """
+
+    def _setData(self, data: np.ndarray, quantizer: Quantizer = None):
+        self.quantizer = quantizer or Quantizer()
+        self.data = data
+        self._sq = self.quantizer.sqNorms(data)
+        self.data_sq = self._sq
+
+    def _updateData(self, data: np.ndarray, ids: np.ndarray):
+        self._sq = growBuffer(self._sq, len(data))
+        self._sq[ids] = self.quantizer.sqNorms(data[ids])
+        self.data = data
+        self.data_sq = self._sq[:len(data)]
+
+
+class ExactIndex(VectorIndex):
+    """
+    Brute force search, compares every query to every vector
+    """
+
+    def build(self, data: np.ndarray, quantizer: Quantizer = None):
+        self._setData(data, quantizer)
+
+    def update(self, data: np.ndarray, ids: np.ndarray):
+        """
+        Refreshes the index after the vectors at ids were added or replaced
+        :param data: The (grown) data
+        :param ids: The changed rows
+        """
+        self._updateData(data, ids)
+
+    def getParams(self) -> dict:
+        return dict()
+
+    def getState(self) -> dict:
+        """
+        :return: The arrays (besides the data) needed to restore the index
+        """
+        return dict()
+
+    def setState(self, data: np.ndarray, state: dict, quantizer: Quantizer = None):
+        self._setData(data, quantizer)
+
+    def search(self, queries: np.ndarray, k: int, chunk_size: int) -> np.ndarray:
+        """
+        :return: (N, k) ids of the nearest vectors (not sorted by distance)
+        """
+        queries = self.quantizer.scaleQueries(queries)
+        nn_idxs = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            dists = sqDistances(chunk, self.data, self.data_sq)
+            nn_idxs[start:start + len(chunk)] = topK(dists, np.arange(len(self.data)), k)[1]
+        return nn_idxs
+
+
+def kMeans(data: np.ndarray, n_clusters: int, n_iter: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Lloyd's k-means
+    :param data: (N, D) vectors
+    :param n_clusters: Number of clusters
+    :param n_iter: Number of iterations
+    :param seed: Random seed of the initial centroids
+    :return: (n_clusters, D) centroids
+    """
+    rng = np.random.RandomState(seed)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = sqDistances(data, centroids, (centroids ** 2).sum(axis=1)).argmin(axis=1)
+        counts = np.bincount(assign, minlength=n_clusters)
+        filled = counts > 0
+        order = np.argsort(assign, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.add.reduceat(data[order], starts[filled], axis=0)
+        centroids[filled] = sums / counts[filled, np.newaxis]
+        # Empty clusters restart from a random vector
+        centroids[~filled] = data[rng.choice(len(data), (~filled).sum())]
+    return centroids
+
+
+class IVFIndex(VectorIndex):
+    """
+    Inverted file index: the vectors are clustered with k-means, and a query is only compared
+    to the vectors of its n_probe nearest clusters. n_probe is the recall/speed knob,
+    a query scans about n_probe / n_lists of the data.
+    """
+    # New vectors are assigned to the existing clusters, the clusters are retrained once
+    # (REBUILD_GROWTH - 1) X the built size vectors were added or replaced
+    REBUILD_GROWTH = 4
+
+    def __init__(self, n_lists: int = 64, n_probe: int = 8, n_iter: int = 10, train_size: int = 256, seed: int = 0):
+        """
+        :param n_lists: Number of clusters
+        :param n_probe: Number of clusters to search for every query
+        :param n_iter: k-means iterations
+        :param train_size: k-means is trained on up to train_size X n_lists vectors
+        :param seed: Random seed
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.seed = seed
+
+    def build(self, data: np.ndarray, quantizer: Quantizer = None):
+        self._setData(data, quantizer)
+        self._built_size = len(data)
+        self._changed = 0
+        n_lists = min(self.n_lists, len(data))
+
+        rng = np.random.RandomState(self.seed)
+        train = data
+        if len(data) > self.train_size * n_lists:
+            train = data[rng.choice(len(data), self.train_size * n_lists, replace=False)]
+        self.centroids = kMeans(self.quantizer.decode(train), n_lists, self.n_iter, self.seed)
+        self.centroids_sq = (self.centroids ** 2).sum(axis=1)
+
+        self._assign = self._nearestList(data)
+        self.assign = self._assign
+        self._buildLists()
+
+    def _nearestList(self, vectors: np.ndarray) -> np.ndarray:
+        assign = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), 4096):
+            chunk = self.quantizer.decode(vectors[start:start + 4096])
+            assign[start:start + len(chunk)] = sqDistances(chunk, self.centroids, self.centroids_sq).argmin(axis=1)
+        return assign
+
+    def update(self, data: np.ndarray, ids: np.ndarray):
+        """
+        Refreshes the index after the vectors at ids were added or replaced
+        :param data: The (grown) data
+        :param ids: The changed rows
+        """
+        self._changed += len(ids)
+        if self._changed >= (self.REBUILD_GROWTH - 1) * self._built_size:
+            self.build(data, self.quantizer)
+            return
+        self._updateData(data, ids)
+        self._assign = growBuffer(self._assign, len(data))
+        self._assign[ids] = self._nearestList(data[ids])
+        self.assign = self._assign[:len(data)]
+        # The lists are rebuilt by the next search
+        self.list_ids = None
+
+    def getParams(self) -> dict:
+        return {'n_lists': self.n_lists, 'n_probe': self.n_probe, 'n_iter': self.n_iter,
+                'train_size': self.train_size, 'seed': self.seed}
+
+    def getState(self) -> dict:
+        """
+        :return: The arrays (besides the data) needed to restore the index
+        """
+        return {'centroids': self.centroids, 'assign': self.assign}
+
+    def setState(self, data: np.ndarray, state: dict, quantizer: Quantizer = None):
+        self._setData(data, quantizer)
+        self._built_size = len(data)
+        self._changed = 0
+        self.centroids = np.asarray(state['centroids'])
+        self.centroids_sq = (self.centroids ** 2).sum(axis=1)
+        self._assign = np.asarray(state['assign'])
+        self.assign = self._assign
+        self._buildLists()
+
+    def _buildLists(self):
+        # The members of list l are list_ids[list_offsets[l]:list_offsets[l + 1]]
+        self.list_ids = np.argsort(self.assign, kind='stable')
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(self.assign, minlength=len(self.centroids)))])
+
+    def search(self, queries: np.ndarray, k: int, chunk_size: int) -> np.ndarray:
+        """
+        :return: (N, k) ids of the nearest vectors (not sorted by distance), -1 where less than k
+                 vectors were found in the probed clusters
+        """
+        if self.list_ids is None:
+            self._buildLists()
+        n_probe = min(self.n_probe, len(self.centroids))
+        nn_idxs = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            probes = topK(sqDistances(chunk, self.centroids, self.centroids_sq),
+                          np.arange(len(self.centroids)), n_probe)[1]
+            chunk = self.quantizer.scaleQueries(chunk)
+
+            best_d = np.full((len(chunk), k), np.inf, dtype=np.float32)
+            best_i = np.full((len(chunk), k), -1, dtype=np.int64)
+            # Every cluster is compared at once to all the queries that probe it
+            for l_idx in np.unique(probes):
+                q_idxs = np.flatnonzero((probes == l_idx).any(axis=1))
+                members = self.list_ids[self.list_offsets[l_idx]:self.list_offsets[l_idx + 1]]
+                if len(members) == 0:
+                    continue
+                dists = sqDistances(chunk[q_idxs], self.data[members], self.data_sq[members])
+                cat_d = np.hstack([best_d[q_idxs], dists])
+                cat_i = np.hstack([best_i[q_idxs], np.broadcast_to(members, dists.shape)])
+                best_d[q_idxs], best_i[q_idxs] = topK(cat_d, cat_i, k)
+            nn_idxs[start:start + len(chunk)] = best_i
+        return nn_idxs
 
 
 class NOT_SKLEARN_KNN(object):
-    def __init__(self, n_neightbors=5):
+    def __init__(self, n_neightbors=5, chunk_size=1024, index=None, capacity=None, eviction='fifo', seed=0,
+                 storage='float32'):
+        """
+        :param n_neightbors: Number of neighbors that vote
+        :param chunk_size: Number of queries whose distances are computed at once,
+                           the distances matrix takes chunk_size X len(data) floats
+        :param index: The search index (ExactIndex, IVFIndex), exact search by default
+        :param capacity: Maximal number of kept vectors, None for unbounded
+        :param eviction: Which vectors make room once at capacity: 'fifo' replaces the oldest,
+                         'reservoir' keeps a uniform sample of everything seen
+        :param seed: Seed of the reservoir sampling
+        :param storage: Type of the kept vectors: float32, float16 or int8 (see Quantizer)
+        """
+        if eviction not in ('fifo', 'reservoir'):
+            sys.exit("Error: Unknown eviction %s, use: [fifo,reservoir]" % eviction)
         self.k_neigh = n_neightbors
+        self.chunk_size = chunk_size
+        self.index = index if index is not None else ExactIndex()
+        self.capacity = capacity
+        self.eviction = eviction
+        self._rng = np.random.default_rng(seed)
+        self.quantizer = Quantizer(storage)
         self.data = []
         self.labels = []
         self.cats = []
+        # Number of vectors passed to fit / partial_fit, including the evicted ones
+        self.n_seen = 0
 
     def fit(self, data, labels):
-        self.data = data
-        self.labels = labels
-        self.cats = [x for x in range(4)]
+        self.data = []
+        self.labels = []
+        self.cats = []
+        self.n_seen = 0
+        self.partial_fit(data, labels)
+
+    def _slots(self, n: int) -> np.ndarray:
+        """
+        :return: The rows of the next n vectors, -1 for a vector the reservoir drops
+        """
+        t = self.n_seen + np.arange(n)
+        self.n_seen += n
+        if self.capacity is None:
+            return t
+        slots = t.copy()
+        full = t >= self.capacity
+        if self.eviction == 'fifo':
+            slots[full] = t[full] % self.capacity
+        else:
+            j = self._rng.integers(0, t[full] + 1)
+            slots[full] = np.where(j < self.capacity, j, -1)
+        return slots
+
+    def partial_fit(self, data, labels):
+        """
+        Adds vectors to the fitted ones, the data lives in a preallocated buffer that doubles when full,
+        and the index is updated instead of rebuilt
+        :param data: (N, ...) vectors
+        :param labels: (N,) their labels
+        """
+        data = np.asarray(data, dtype=np.float32).reshape(len(data), -1)
+        labels = np.asarray(labels)
+        slots = self._slots(len(data))
+        # A slot written twice in the batch keeps the last vector
+        rev_slots = slots[::-1]
+        _, first = np.unique(rev_slots, return_index=True)
+        keep = len(slots) - 1 - first[rev_slots[first] >= 0]
+        data, labels, slots = data[keep], labels[keep], slots[keep]
+        if len(slots) == 0:
+            return
+
+        first_fit = len(self.data) == 0
+        # Vectors outside of the int8 range widen it, the stored vectors are then re-encoded and the index rebuilt
+        old_quantizer = Quantizer(self.quantizer.dtype, self.quantizer.scale, self.quantizer.offset)
+        rebuild = first_fit or self.quantizer.extend(data)
+        if first_fit:
+            self.quantizer.fit(data)
+            self._data_buf = np.empty((0, data.shape[1]), dtype=Quantizer.DTYPES[self.quantizer.dtype])
+            self._labels_buf = np.empty(0, dtype=labels.dtype)
+        elif data.shape[1] != self.data.shape[1]:
+            sys.exit("Error: Vectors of size %d, the KNN has %d" % (data.shape[1], self.data.shape[1]))
+        n = max(len(self.data), slots.max() + 1)
+        self._data_buf = growBuffer(self._data_buf, n)
+        self._labels_buf = growBuffer(self._labels_buf.astype(np.result_type(self._labels_buf, labels), copy=False), n)
+        if rebuild and not first_fit:
+            self.quantizer.reencode(self._data_buf[:len(self.data)], old_quantizer)
+        self._data_buf[slots] = self.quantizer.encode(data)
+        self._labels_buf[slots] = labels
+        self.data = self._data_buf[:n]
+        self.labels = self._labels_buf[:n]
+        # Starts from the first labels, so cats (and predict) keep the labels dtype
+        self.cats = np.unique(labels) if first_fit else np.union1d(self.cats, labels)
+        if rebuild:
+            self.index.build(self.data, self.quantizer)
+        else:
+            self.index.update(self.data, slots)
+
+    def kneighbors(self, new_data) -> np.ndarray:
+        """
+        Finds the nearest neighbors of a batch of queries
+        :param new_data: (N, D) queries
+        :return: (N, k) indices of the neighbors (not sorted by distance), -1 for a missing neighbor
+        """
+        new_data = np.asarray(new_data, dtype=np.float32).reshape(len(new_data), -1)
+        return self.index.search(new_data, min(self.k_neigh, len(self.data)), self.chunk_size)
 
     def predict(self, new_data):
         if np.any(np.array([len(x) for x in [self.labels, self.cats, self.data]]) < 1):
             sys.exit("Error: KNN model not fitted.")
-        lbls = []
-        for samp in new_data:
-            nn_idxs = np.power(samp - self.data, 2).sum(axis=1).argsort()[:self.k_neigh]
+        # Votes per category, ties go to the first category (as np.argmax)
+        nn_idxs = self.kneighbors(new_data)
+        nn_cats = np.searchsorted(self.cats, self.labels[nn_idxs])
+        n_cats = len(self.cats)
+        votes = np.bincount((nn_cats + n_cats * np.arange(len(nn_cats))[:, np.newaxis]).ravel(),
+                            weights=(nn_idxs >= 0).ravel(),
+                            minlength=len(nn_cats) * n_cats).reshape(-1, n_cats)
+        return self.cats[votes.argmax(axis=1)]
+
+    def save(self, path: str, tags: dict = None, dtype=np.float32):
+        """
+        Saves the fitted embeddings, labels and index to a folder
+        :param path: The folder
+        :param tags: Values that must match when loading (e.g. the model checksum)
+        :param dtype: The storage type of float32 embeddings (float16 halves the size, and is the storage
+                      of the loaded knn), quantized embeddings are saved as they are
+        """
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+        if self.quantizer.dtype != 'float32':
+            dtype = self.data.dtype
+        np.save(os.path.join(path, 'data.npy'), self.data.astype(dtype))
+        quantizer_state = self.quantizer.getState()
+        for name, arr in quantizer_state.items():
+            np.save(os.path.join(path, 'quantizer_%s.npy' % name), arr)
+        np.save(os.path.join(path, 'labels.npy'), self.labels)
+        index_state = self.index.getState()
+        for name, arr in index_state.items():
+            np.save(os.path.join(path, 'index_%s.npy' % name), arr)
+
+        meta = {'k_neigh': self.k_neigh, 'chunk_size': self.chunk_size,
+                'capacity': self.capacity, 'eviction': self.eviction, 'n_seen': self.n_seen,
+                'storage': self.quantizer.dtype, 'quantizer_state': list(quantizer_state.keys()),
+                'index': type(self.index).__name__, 'index_params': self.index.getParams(),
+                'index_state': list(index_state.keys()), 'tags': tags or dict()}
+        # The meta file is written last, it marks a complete store
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    @staticmethod
+    def load(path: str, tags: dict = None):
+        """
+        Loads a knn saved with save(), the embeddings are memory-mapped
+        :param path: The folder
+        :param tags: Values that must match the saved ones
+        :return: The knn, None if there is no (matching) saved knn
+        """
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['tags'] != json.loads(json.dumps(tags or dict())):
+            return None
+
+        data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+        storage = meta.get('storage', 'float32')
+        if storage == 'float32':
+            # float32 embeddings saved with a smaller dtype are searched in that dtype, the memmap is kept
+            storage = data.dtype.name
+        quantizer = Quantizer(storage, **{name: np.load(os.path.join(path, 'quantizer_%s.npy' % name))
+                                          for name in meta.get('quantizer_state', [])})
+        index = INDEX_TYPES[meta['index']](**meta['index_params'])
+        index.setState(data, {name: np.load(os.path.join(path, 'index_%s.npy' % name))
+                              for name in meta['index_state']}, quantizer)
+
+        knn = NOT_SKLEARN_KNN(meta['k_neigh'], meta['chunk_size'], index,
+                              meta.get('capacity'), meta.get('eviction', 'fifo'))
+        knn.quantizer = quantizer
+        # partial_fit copies the read-only memmap before writing to it
+        knn.data = knn._data_buf = data
+        knn.labels = knn._labels_buf = np.load(os.path.join(path, 'labels.npy'))
+        knn.cats = np.unique(knn.labels)
+        knn.n_seen = meta.get('n_seen', len(data))
+        return knn
+
+
+INDEX_TYPES = {'ExactIndex': ExactIndex, 'IVFIndex': IVFIndex}
+
+
+def modelChecksum(model_path: str) -> str:
+    """
+    Hash of the contents of a saved model (file or SavedModel folder)
+    """
+    model_files = [model_path]
+    if os.path.isdir(model_path):
+        model_files = sorted(os.path.join(root, x) for root, _, files in os.walk(model_path) for x in files)
+
+    sha = hashlib.sha1()
+    for f_path in model_files:
+        sha.update(os.path.relpath(f_path, model_path).encode('utf-8'))
+        with open(f_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def knnRecall(knn: NOT_SKLEARN_KNN, queries: np.ndarray) -> float:
+    """
+    Measures how many of the exact nearest neighbors the knn's index finds
+    :param knn: A fitted knn
+    :param queries: (N, D) queries
+    :return: The recall, in [0, 1]
+    """
+    exact = NOT_SKLEARN_KNN(knn.k_neigh, knn.chunk_size)
+    exact.fit(knn.quantizer.decode(knn.data), knn.labels)
+    exact_idxs = exact.kneighbors(queries)
+    found = knn.kneighbors(queries)
+    hits = sum(len(np.intersect1d(a, b)) for a, b in zip(exact_idxs, found))
+    return hits / exact_idxs.size
+
+
+def imageSignature(img_path: str) -> str:
+    """
+    The size and modification time of an image file (as folderSignature), a rewritten image gets a new signature.
+    Shard records are never rewritten in place, they get the signature of their shard file.
+    :return: "size:mtime_ns", None if the file does not exist
+    """
+    try:
+        f_stat = os.stat(img_path.rsplit(SHARD_SEP, 1)[0] if SHARD_SEP in img_path else img_path)
+    except OSError:
+        return None
+    return '%d:%d' % (f_stat.st_size, f_stat.st_mtime_ns)
 
-            lbls_lst = self.labels[nn_idxs]
-            lbls_count = np.array([sum(lbls_lst == x) for x in self.cats])
-            best_lbl = self.cats[lbls_count.argmax()]
-            lbls.append(best_lbl)
-        return lbls
 
+class EmbeddingCache(object):
+    """
+    Append-only on-disk store of image embeddings, keyed by image path and signature (see imageSignature).
+    The vectors are the rows of a raw float32 file, paths.txt lists the image and signature of every row and is
+    appended after the rows are written, so an interrupted run only loses its last chunk.
+    A re-embedded image gets a new row, the last row of a path is the current one.
+    One cache folder holds the embeddings of one model.
+    """
 
-def getKNN(nn_model, images: np.ndarray, labels: np.ndarray):
-    imgs_vecs = nn_model.predict(images)
-    knn = NOT_SKLEARN_KNN(n_neightbors=5)
+    def __init__(self, folder: str):
+        os.makedirs(folder, exist_ok=True)
+        self.vecs_path = os.path.join(folder, 'embeddings.f32')
+        self.paths_path = os.path.join(folder, 'paths.txt')
+        self.meta_path = os.path.join(folder, 'meta.json')
+        self.dim = None
+        # Image path -> (row, signature)
+        self.rows = dict()
+        self.n_rows = 0
+        self._vecs = None
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)['dim']
+            if os.path.isfile(self.paths_path):
+                self._loadPaths()
+        # Drops the rows of an interrupted append
+        with open(self.vecs_path, 'ab') as f:
+            f.truncate(self.n_rows * (self.dim or 0) * 4)
+
+    def _loadPaths(self):
+        with open(self.paths_path, 'rb') as f:
+            data = f.read()
+        # A last line without a newline is from an interrupted append, it is cut so the next append starts clean
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            with open(self.paths_path, 'ab') as f:
+                f.truncate(complete)
+        for line in data[:complete].decode('utf-8').splitlines():
+            fields = line.split('\t')
+            # Rows of older caches have no signature, they never match
+            self.rows[fields[0]] = (self.n_rows, fields[1] if len(fields) > 1 else None)
+            self.n_rows += 1
+
+    def isCurrent(self, img_path: str, signature: str = None) -> bool:
+        """
+        :param img_path: The image
+        :param signature: Its current signature, read from the file if not given
+        :return: True if the cache has the embedding of this version of the image
+        """
+        if img_path not in self.rows:
+            return False
+        signature = signature if signature is not None else imageSignature(img_path)
+        return signature is not None and self.rows[img_path][1] == signature
+
+    def __contains__(self, img_path: str) -> bool:
+        return self.isCurrent(img_path)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, img_paths: list, vecs: np.ndarray, signatures: list = None):
+        """
+        :param img_paths: The embedded images, the ones already in the cache with the same signature are skipped
+        :param vecs: (N, D) their embeddings
+        :param signatures: The signatures of the images when they were read, read from the files if not given
+        """
+        vecs = np.asarray(vecs, dtype=np.float32).reshape(len(vecs), -1)
+        if self.dim is None:
+            self.dim = vecs.shape[1]
+            with open(self.meta_path, 'w') as f:
+                json.dump({'dim': self.dim}, f)
+        elif vecs.shape[1] != self.dim:
+            sys.exit("Error: Embeddings of size %d, the cache has %d" % (vecs.shape[1], self.dim))
+        if signatures is None:
+            signatures = [imageSignature(x) for x in img_paths]
+
+        new_lines = list()
+        new_idxs = list()
+        for i, (img_path, signature) in enumerate(zip(img_paths, signatures)):
+            if signature is not None and not self.isCurrent(img_path, signature):
+                self.rows[img_path] = (self.n_rows, signature)
+                self.n_rows += 1
+                new_lines.append('%s\t%s\n' % (img_path, signature))
+                new_idxs.append(i)
+        with open(self.vecs_path, 'ab') as f:
+            f.write(np.ascontiguousarray(vecs[new_idxs]).tobytes())
+        with open(self.paths_path, 'a') as f:
+            f.write(''.join(new_lines))
+        self._vecs = None
+
+    def get(self, img_paths: list) -> np.ndarray:
+        """
+        :return: (N, D) embeddings of cached images
+        """
+        if self._vecs is None:
+            self._vecs = np.memmap(self.vecs_path, dtype=np.float32, mode='r', shape=(self.n_rows, self.dim))
+        return self._vecs[[self.rows[x][0] for x in img_paths]]
+
+
+def modelCacheFolder(cache_dir: str, model_path: str, **params) -> str:
+    """
+    :return: The embeddings cache folder of a model and pre-processing params
+    """
+    key = json.dumps(dict(model=modelChecksum(model_path), **params), sort_keys=True)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def embedImages(nn_model, img_paths: list, img_size: int, normalize: bool = True, cache: EmbeddingCache = None,
+                chunk_size: int = 2048, batch_size: int = 256, n_workers: int = None) -> (np.ndarray, np.ndarray):
+    """
+    Embeds images streamed from disk: chunk_size images are decoded at a time and go through the model
+    in batches of batch_size, so only one chunk of images is in memory. With a cache only the images
+    it does not have are embedded, and their embeddings are added to it.
+    :param nn_model: The encoder
+    :param img_paths: The images (paths or shard refs)
+    :param img_size: The model input height/width
+    :param normalize: True to scale the images to [0, 1]
+    :param cache: Embeddings of previous runs of the same model
+    :param chunk_size: Number of images decoded at once
+    :param batch_size: The model batch size
+    :param n_workers: Number of decoding processes, None for all cores
+    :return: (N', D) embeddings of the images that could be read, and a boolean vector of those images
+    """
+    img_paths = list(img_paths)
+    signatures = None
+    cached = np.zeros(len(img_paths), dtype=bool)
+    if cache is not None:
+        # The signatures are read before the images, an image rewritten meanwhile is embedded again on the next run
+        signatures = [imageSignature(x) for x in img_paths]
+        cached = np.array([cache.isCurrent(x, y) for x, y in zip(img_paths, signatures)], dtype=bool)
+    todo = np.flatnonzero(~cached)
+    valid = np.ones(len(img_paths), dtype=bool)
+    print("Embedding %d images (%d cached)" % (len(todo), cached.sum()))
+
+    n_workers = n_workers or os.cpu_count() or 1
+    # One pool for all the chunks, the workers are started (and import their modules) once
+    pool = Pool(min(n_workers, len(todo))) if n_workers > 1 and len(todo) > 1 else None
+    out = None
+    try:
+        for start in range(0, len(todo), chunk_size):
+            rows = todo[start:start + chunk_size]
+            chunk_paths = [img_paths[i] for i in rows]
+            imgs, ok = decodeImages(chunk_paths, img_size, n_workers=n_workers, pool=pool)
+            valid[rows[~ok]] = False
+            if not ok.any():
+                continue
+            imgs = imgs[ok]
+            if normalize:
+                imgs /= 255.0
+            vecs = np.asarray(nn_model.predict(imgs, batch_size=batch_size), dtype=np.float32).reshape(len(imgs), -1)
+            if out is None:
+                out = np.empty((len(img_paths), vecs.shape[1]), dtype=np.float32)
+            out[rows[ok]] = vecs
+            if cache is not None:
+                cache.append([img_paths[i] for i in rows[ok]], vecs, [signatures[i] for i in rows[ok]])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if cached.any():
+        cached_vecs = cache.get([x for x, is_cached in zip(img_paths, cached) if is_cached])
+        if out is None:
+            out = np.empty((len(img_paths), cached_vecs.shape[1]), dtype=np.float32)
+        out[cached] = cached_vecs
+    if out is None:
+        return np.empty((0, 0), dtype=np.float32), valid
+    return out[valid], valid
+
+
+def getKNN(imgs_vecs: np.ndarray, labels: np.ndarray, index=None, storage: str = 'float32'):
+    knn = NOT_SKLEARN_KNN(n_neightbors=5, index=index, storage=storage)
     knn.fit(imgs_vecs, labels)
     return knn
 
 
-def main(model_path: str, img_fld: str):
-    # Training the KNN
-    model = keras.models.load_model(model_path)
+def makeIndex(index_type: str, n_lists: int = 64, n_probe: int = 8):
+    if index_type == 'exact':
+        return ExactIndex()
+    elif index_type == 'ivf':
+        return IVFIndex(n_lists=n_lists, n_probe=n_probe)
+    sys.exit("Error: Unknown index type %s, use: [exact,ivf]" % index_type)
+
+
+def fitKNN(model, model_path: str, img_fld: str, index_type: str = 'exact', n_lists: int = 64, n_probe: int = 8,
+           knn_cache: str = None, cache_dtype: str = 'float32', feature_cache: str = None, batch_size: int = 256,
+           storage: str = 'float32'):
+    """
+    Fits the KNN on the train images embeddings, or loads it from knn_cache when it was saved for
+    the same model, images and index
+    :param feature_cache: Folder of the per-image embeddings cache, None to embed every image
+    :param storage: Type of the KNN embeddings: float32, float16 or int8
+    :return: knn, test image paths, test_y
+    """
     img_h = img_w = model.inputs[0].shape[1]
-    train_x, test_x, train_y, test_y = prepareData(
-        img_fld,
-        img_h,
-        sample_size=-30,
-        normalize=True)
+    sample_size = -30
+    img_paths, labels, _ = listImages(img_fld, sample_size)
+    train_paths, test_paths, train_y, test_y = NOT_SK_LEARN_train_test_split(
+        np.array(img_paths),
+        labels,
+        test_size=0.3,
+        random_state=24)
+
+    knn = knn_tags = None
+    if knn_cache:
+        # The saved knn is only valid for the same model, images and index
+        knn_tags = {'model': modelChecksum(model_path),
+                    'data': cacheKey(img_fld, img_size=img_h, sample_size=sample_size),
+                    'index': index_type, 'n_lists': n_lists, 'storage': storage}
+        knn = NOT_SKLEARN_KNN.load(knn_cache, knn_tags)
+    if knn is not None:
+        print("Loaded KNN model from %s" % knn_cache)
+        if isinstance(knn.index, IVFIndex):
+            knn.index.n_probe = n_probe
+    else:
+        print("Building KNN model..")
+        cache = None
+        if feature_cache:
+            cache = EmbeddingCache(modelCacheFolder(feature_cache, model_path, img_size=img_h, normalize=True))
+        train_vecs, valid = embedImages(model, train_paths, img_h, cache=cache, batch_size=batch_size)
+        knn = getKNN(train_vecs, train_y[valid], makeIndex(index_type, n_lists, n_probe), storage)
+        if knn_cache:
+            knn.save(knn_cache, knn_tags, dtype=cache_dtype)
+    return knn, test_paths, test_y
+
 
-    print("Building KNN model..")
-    knn = getKNN(model, train_x, train_y)
+def main(model_path: str, img_fld: str, index_type: str = 'exact', n_lists: int = 64, n_probe: int = 8,
+         knn_cache: str = None, cache_dtype: str = 'float32', feature_cache: str = None, batch_size: int = 256,
+         storage: str = 'float32'):
+    # Training the KNN
+    model = keras.models.load_model(model_path)
+    knn, test_paths, test_y = fitKNN(model, model_path, img_fld, index_type, n_lists, n_probe, knn_cache,
+                                     cache_dtype, feature_cache, batch_size, storage)
 
     print("Predicting the Test dataset..")
-    test_vecs = model.predict(test_x)
+    cache = None
+    if feature_cache:
+        cache = EmbeddingCache(modelCacheFolder(feature_cache, model_path, img_size=model.inputs[0].shape[1],
+                                                normalize=True))
+    test_vecs, valid = embedImages(model, test_paths, model.inputs[0].shape[1], cache=cache, batch_size=batch_size)
+    test_y = test_y[valid]
     test_pred = knn.predict(test_vecs)
     accuracy = np.asarray(test_pred == test_y).sum() / len(test_y)
     print("Accuracy: %f" % accuracy)
+    if not isinstance(knn.index, ExactIndex):
+        print("Recall (vs. exact search): %f" % knnRecall(knn, test_vecs))
 
 
 if __name__ == '__main__':
@@ -68,7 +839,25 @@ if __name__ == '__main__':
                         help='The trained model to load')
     parser.add_argument('--images', dest="img_folder", type=str, required=True,
                         help='Location of the images')
+    parser.add_argument('--index', dest="index", type=str, default='exact',
+                        help='Nearest neighbors search: exact or ivf (approximate)')
+    parser.add_argument('--n_lists', dest="n_lists", type=int, default=64,
+                        help='Number of clusters of the ivf index')
+    parser.add_argument('--n_probe', dest="n_probe", type=int, default=8,
+                        help='Number of clusters the ivf index searches, higher is slower with better recall')
+    parser.add_argument('--knn_cache', dest="knn_cache", type=str,
+                        help='Folder to save/load the fitted KNN (skips embedding the train images)')
+    parser.add_argument('--cache_dtype', dest="cache_dtype", type=str, default='float32',
+                        help='Storage type of the saved embeddings: float32 or float16')
+    parser.add_argument('--feature_cache', dest="feature_cache", type=str,
+                        default=os.path.join('data', 'cache', 'embeddings'),
+                        help='Folder of the per-image embeddings cache, only new images are embedded')
+    parser.add_argument('--batch_size', dest="batch_size", type=int, default=256,
+                        help='Encoder batch size')
+    parser.add_argument('--storage', dest="storage", type=str, default='float32',
+                        help='Type of the KNN embeddings: float32, float16 or int8 (2x/4x less memory)')
 
     args = parser.parse_args()
 
-    main(args.model, args.img_folder)
+    main(args.model, args.img_folder, args.index, args.n_lists, args.n_probe, args.knn_cache, args.cache_dtype,
+         args.feature_cache, args.batch_size, args.storage)
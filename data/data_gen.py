@@ -1,32 +1,204 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from multiprocessing import Pool
+
 import pandas as pd
 import numpy as np
-import os
 import cv2
 
-from utils import rle_to_mask
+from utils import SHARD_INDEX, SHARD_SEP, ShardWriter, isShardFolder, rle_to_mask
+
+
+CATEGORIES = ["Fish", "Flower", "Sugar", "Gravel"]
+MANIFEST_NAME = 'manifest.json'
+
+
+def groupByImage(data: pd.DataFrame) -> list:
+    """
+    Groups the label rows by their source image, so each image is read only once
+    :param data: The train.csv rows
+    :return: List of (image name, [(cloud type, RLE), ...])
+    """
+    image_labels = dict()
+    for label, rle in zip(data.iloc[:, 0], data.iloc[:, 1]):
+        img_name, img_type = label.split('_')
+        image_labels.setdefault(img_name, []).append((img_type, rle))
+    return list(image_labels.items())
+
+
+def runPool(worker, tasks: list, n_workers: int = None, on_done=None) -> int:
+    """
+    Runs the per-image worker over a pool of processes and reports the throughput
+    :param worker: Function of a single task, returns the files it wrote
+    :param tasks: The tasks
+    :param n_workers: Number of processes, None for all cores
+    :param on_done: Optional callback(task, files) called for every finished task
+    :return: Total number of files written
+    """
+    if len(tasks) == 0:
+        return 0
+    n_workers = n_workers or os.cpu_count() or 1
+    start_time = time.time()
+    n_written = 0
+    with Pool(n_workers) as pool:
+        done = pool.imap_unordered(_runTask, [(worker, task) for task in tasks], chunksize=4)
+        for i, (task, files) in enumerate(done):
+            n_written += len(files)
+            if on_done is not None:
+                on_done(task, files)
+            if (i + 1) % 100 == 0 or i + 1 == len(tasks):
+                elapsed = time.time() - start_time
+                print("\r%d/%d images, %d files, %.1f images/sec" % (i + 1, len(tasks), n_written,
+                                                                     (i + 1) / elapsed), end='')
+    print()
+    return n_written
+
+
+def _runTask(worker_task: tuple) -> (tuple, list):
+    worker, task = worker_task
+    return task, worker(task)
+
+
+def loadManifest(output: str) -> dict:
+    """
+    Loads the manifest of a generated dataset, it records for each source image the hash of its labels
+    and the files that were generated from it.
+    :param output: The dataset folder
+    :return: The manifest, empty if the folder has none
+    """
+    manifest_path = os.path.join(output, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return {'images': {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def saveManifest(output: str, manifest: dict):
+    manifest_path = os.path.join(output, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def labelsHash(img_path: str, labels: list, params: dict) -> str:
+    """
+    Hash of everything an image's output depends on: its labels, the source file and the generation parameters
+    """
+    img_stat = os.stat(img_path)
+    key_data = json.dumps([sorted(labels), img_stat.st_size, img_stat.st_mtime_ns, params], sort_keys=True)
+    return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+
+def fileExists(output: str, f_name: str, store: ShardWriter = None) -> bool:
+    if SHARD_SEP in f_name:
+        return store is not None and store.exists(f_name)
+    return os.path.isfile(os.path.join(output, f_name))
+
+
+def removeFiles(output: str, files: list, store: ShardWriter = None):
+    for f_name in files:
+        if SHARD_SEP in f_name:
+            if store is not None:
+                store.remove(f_name)
+        elif os.path.isfile(os.path.join(output, f_name)):
+            os.remove(os.path.join(output, f_name))
+
+
+def buildIncremental(worker, data: pd.DataFrame, images_path: str, output: str, params: dict,
+                     n_workers: int = None, save_every: int = 100, store: ShardWriter = None):
+    """
+    Runs the worker only for the images that are new or changed since the last run (see the manifest),
+    the output of images that changed or left the csv is removed. The manifest is saved as the work
+    progresses, so an interrupted run continues where it stopped.
+    :param worker: Function of a (image name, labels, images folder, output folder, params) task,
+                   returns the files it wrote (relative to the output folder), or (category, name, image)
+                   tuples to pack into the store
+    :param data: The train.csv rows
+    :param images_path: The source images folder
+    :param output: The dataset folder
+    :param params: The generation parameters, passed to the worker
+    :param n_workers: Number of processes, None for all cores
+    :param save_every: Save the manifest every that many images
+    :param store: Optional ShardWriter that packs the images the worker returns
+    """
+    manifest = loadManifest(output)
+    entries = manifest['images']
+    groups = groupByImage(data)
+
+    tasks = []
+    new_hashes = dict()
+    for img_name, labels in groups:
+        img_hash = labelsHash(os.path.join(images_path, img_name), labels, params)
+        entry = entries.get(img_name)
+        if entry is not None:
+            if entry['hash'] == img_hash and all(fileExists(output, x, store) for x in entry['files']):
+                continue
+            removeFiles(output, entry['files'], store)
+            del entries[img_name]
+        new_hashes[img_name] = img_hash
+        tasks.append((img_name, labels, images_path, output, params))
+
+    for img_name in set(entries.keys()) - set(x[0] for x in groups):
+        removeFiles(output, entries.pop(img_name)['files'], store)
+
+    print("%d images up to date, %d to process" % (len(groups) - len(tasks), len(tasks)))
+
+    def save():
+        # The manifest goes first, records it references that were never indexed are just generated again
+        saveManifest(output, manifest)
+        if store is not None:
+            store.flush()
 
+    def onDone(task, files):
+        if store is not None:
+            files = [store.write(img_type, name, img) for img_type, name, img in files]
+        entries[task[0]] = {'hash': new_hashes[task[0]], 'files': files}
+        if len(entries) % save_every == 0:
+            save()
 
-def genDataWithMasks(data):
+    try:
+        runPool(worker, tasks, n_workers, onDone)
+    finally:
+        save()
+        if store is not None:
+            store.close()
+
+
+def maskImage(task: tuple) -> list:
+    """
+    Saves a quarter size copy of an image and of its mask for each of its cloud types
+    :param task: (image name, [(cloud type, RLE), ...], images folder, output folder, params)
+    :return: The files written
+    """
+    img_name, labels, images_path, output, params = task
+    img = cv2.imread(os.path.join(images_path, img_name))
+    h, w, _ = img.shape
+
+    img = cv2.resize(img, (0, 0), fx=params['scale'], fy=params['scale'])
+    out_h, out_w, _ = img.shape
+    files = []
+    for img_type, rle in labels:
+        pix = rle_to_mask(rle, w, h, out_size=(out_w, out_h)).round().astype(np.uint8)
+
+        files += [os.path.join(img_type, img_name), os.path.join(img_type, 'masks', img_name)]
+        cv2.imwrite(os.path.join(output, files[-2]), img)
+        cv2.imwrite(os.path.join(output, files[-1]), pix)
+    return files
+
+
+def genDataWithMasks(data, images_path: str, n_workers: int = None):
     output = os.path.join('data', 'mini_data')
 
-    for t in ["Fish", "Flower", "Sugar", "Gravel"]:
+    for t in CATEGORIES:
         lbl_folder = os.path.join(output, t)
         os.makedirs(lbl_folder, exist_ok=True)
         os.makedirs(os.path.join(lbl_folder, 'masks'), exist_ok=True)
 
-    for row in data.iterrows():
-        img_name, img_type = row[1][0].split('_')
-        img_path = os.path.join(images_path, img_name)
-
-        img = cv2.imread(img_path)
-        h, w, _ = img.shape
-        pix = rle_to_mask(row[1][1], w, h)
-
-        img = cv2.resize(img, (0, 0), fx=0.25, fy=0.25)
-        pix = cv2.resize(pix, (0, 0), fx=0.25, fy=0.25)
-
-        cv2.imwrite(os.path.join(output, img_type, img_name), img)
-        cv2.imwrite(os.path.join(output, img_type, 'masks', img_name), pix)
+    buildIncremental(maskImage, data, images_path, output, {'scale': 0.25}, n_workers)
 
 
 def getBB(pix_mask):
@@ -45,48 +217,82 @@ def getBB(pix_mask):
     return bbs
 
 
-def genDataBB(data):
+def cropImage(task: tuple) -> list:
+    """
+    Crops the bounding boxes of each cloud type in an image. The crops are named after the source
+    image and their index, so the output does not depend on the processing order.
+    :param task: (image name, [(cloud type, RLE), ...], images folder, output folder, params)
+    :return: The crops written, or (category, name, crop) tuples for the shards format
+    """
+    img_name, labels, images_path, output, params = task
+    out_w, out_h = params['crop_size']
+    img = cv2.imread(os.path.join(images_path, img_name))
+    h, w, _ = img.shape
+    img_stem = os.path.splitext(img_name)[0]
+
+    files = []
+    for img_type, rle in labels:
+        mask = rle_to_mask(rle, w, h)
+
+        bbs = getBB(mask)
+        for k, bb in enumerate(bbs):
+            crop = img[bb[0, 1]:bb[1, 1],
+                   bb[0, 0]:bb[1, 0]]
+            crop = cv2.resize(crop, (out_h, out_w))
+
+            crop_name = os.path.join(img_type, "%s_%02d.png" % (img_stem, k))
+            if params['format'] == 'shards':
+                # Packed by the main process
+                files.append((img_type, crop_name, crop))
+            else:
+                files.append(crop_name)
+                cv2.imwrite(os.path.join(output, crop_name), crop)
+    return files
+
+
+def genDataBB(data, images_path: str, n_workers: int = None, out_format: str = 'png'):
     # Saving the images at size 350X525
     # Each image contains only one type
     output = os.path.join('mini_data')
     os.makedirs(output, exist_ok=True)
 
     out_w, out_h = 256, 256
-    name_counter = 0
 
-    for t in ["Fish", "Flower", "Sugar", "Gravel"]:
+    for t in CATEGORIES:
         lbl_folder = os.path.join(output, t)
         os.makedirs(lbl_folder, exist_ok=True)
 
-    for row in data.iterrows():
-        img_name, img_type = row[1][0].split('_')
-        img_path = os.path.join(images_path, img_name)
+    # The shards format packs the crops into a few binary files instead of a png per crop
+    store = None
+    if out_format == 'shards':
+        store = ShardWriter(output, (out_h, out_w, 3), CATEGORIES)
+    elif isShardFolder(output):
+        # The loaders read the shards of a folder that has them, the old ones would hide the new png crops.
+        # The crops are all generated again, the format is part of the manifest hash
+        shutil.rmtree(os.path.join(output, 'shards'), ignore_errors=True)
+        os.remove(os.path.join(output, SHARD_INDEX))
 
-        img = cv2.imread(img_path)
-        h, w, _ = img.shape
-        mask = rle_to_mask(row[1][1], w, h)
+    buildIncremental(cropImage, data, images_path, output, {'crop_size': [out_w, out_h], 'format': out_format},
+                     n_workers, store=store)
 
-        bbs = getBB(mask)
-        for bb in bbs:
-            crop = img[bb[0, 1]:bb[1, 1],
-                   bb[0, 0]:bb[1, 0]]
-            crop = cv2.resize(crop, (out_h, out_w))
-
-            img_name = "%05d.png" % name_counter
-            cv2.imwrite(os.path.join(output, img_type, img_name), crop)
-            name_counter += 1
 
-
-def main():
+def main(images_path: str, n_workers: int = None, out_format: str = 'png'):
     data = pd.read_csv('train.csv')
     data = data[data['EncodedPixels'].isnull() == False]
     print("Classes:", data.keys())
 
-    genDataBB(data)
+    genDataBB(data, images_path, n_workers, out_format)
 
     print("Done!")
 
 
 if __name__ == "__main__":
-    images_path = "train_images"
-    main()
+    parser = argparse.ArgumentParser(description='Generate the cloud crops dataset')
+    parser.add_argument('--workers', dest="n_workers", type=int,
+                        help='Number of processes (default: all cores)')
+    parser.add_argument('--format', dest="out_format", type=str, default='png', choices=['png', 'shards'],
+                        help='Write a png per crop, or pack the crops into shard files')
+
+    args = parser.parse_args()
+
+    main("train_images", args.n_workers, args.out_format)
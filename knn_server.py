@@ -0,0 +1,220 @@
+""" Classification service for the AutoEncoder/KNN model.
+The encoder and the KNN reference set are loaded once, the incoming images are collected into
+micro-batches that go through a single encoder call and a single vectorized KNN lookup.
+
+Usage:
+    python knn_server.py --model [PATH_TO_SAVED_MODEL]/encoder --images PATH_TO_MINI_DATA [--port PORT]
+
+    POST /classify  (body: a png/jpg image)  ->  {"label": 2, "category": "Sugar"}
+    GET  /stats                              ->  latency percentiles and throughput
+"""
+import argparse
+import collections
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import tensorflow.keras as keras
+
+from classify_knn import fitKNN
+from utils import listCategories
+
+
+class LatencyStats(object):
+    """
+    Latencies and completion times of the last window_size requests
+    """
+
+    def __init__(self, window_size: int = 10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window_size)
+        self.done_times = collections.deque(maxlen=window_size)
+        self.batch_sizes = collections.deque(maxlen=window_size)
+        self.start_time = time.time()
+        self.n_requests = 0
+
+    def addBatch(self, latencies: list):
+        now = time.time()
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.done_times.extend([now] * len(latencies))
+            self.batch_sizes.append(len(latencies))
+            self.n_requests += len(latencies)
+
+    def summary(self) -> dict:
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            done_times = np.array(self.done_times)
+            batch_sizes = np.array(self.batch_sizes)
+            n_requests = self.n_requests
+
+        stats = {'requests': n_requests, 'uptime_sec': time.time() - self.start_time}
+        if len(latencies) > 0:
+            window = max(done_times[-1] - done_times[0], 1e-6)
+            stats.update({
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'requests_per_sec': float((len(done_times) - 1) / window) if len(done_times) > 1 else 0.,
+                'mean_batch_size': float(batch_sizes.mean()),
+            })
+        return stats
+
+
+class MicroBatcher(object):
+    """
+    Collects the submitted samples into batches of up to max_batch samples, waiting at most max_wait_ms
+    after the first sample of a batch, and classifies each batch with one call.
+    """
+
+    def __init__(self, classify_fn, max_batch: int = 32, max_wait_ms: float = 5.):
+        """
+        :param classify_fn: Function of a (N, ...) batch, returns N labels
+        :param max_batch: Maximum batch size
+        :param max_wait_ms: Maximum time to wait for a batch to fill
+        """
+        self.classify_fn = classify_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.stats = LatencyStats()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sample: np.ndarray):
+        """
+        Classifies a single sample, blocks until its batch is done
+        :return: The label
+        """
+        request = {'sample': sample, 'time': time.time(), 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['label']
+
+    def _nextBatch(self) -> list:
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._nextBatch()
+            try:
+                labels = self.classify_fn(np.stack([x['sample'] for x in batch]))
+                for request, label in zip(batch, labels):
+                    request['label'] = label
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            now = time.time()
+            self.stats.addBatch([now - x['time'] for x in batch])
+            for request in batch:
+                request['done'].set()
+
+
+class KNNServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Many clients connect at once, each waiting for its micro-batch
+    request_queue_size = 128
+
+
+def makeHandler(batcher: MicroBatcher, img_size: int, categories: list):
+    class ClassifyHandler(BaseHTTPRequestHandler):
+        def _reply(self, code: int, body: dict):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats.summary())
+            else:
+                self._reply(404, {'error': 'Unknown path'})
+
+        def do_POST(self):
+            if self.path != '/classify':
+                self._reply(404, {'error': 'Unknown path'})
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            img = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                self._reply(400, {'error': 'Could not decode the image'})
+                return
+            # Same pre-processing as utils.prepareData(normalize=True)
+            img = cv2.resize(img, (img_size, img_size)).astype(np.float32) / 255.0
+            try:
+                label = int(batcher.submit(img.reshape((img_size, img_size, 1))))
+            except Exception as e:
+                # The classification of the whole micro-batch failed, the client still gets a reply
+                self._reply(500, {'error': 'Classification failed: %s' % e})
+                return
+            self._reply(200, {'label': label, 'category': categories[label]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ClassifyHandler
+
+
+def main(args: argparse.Namespace):
+    model = keras.models.load_model(args.model)
+    img_size = model.inputs[0].shape[1]
+    knn, _, _ = fitKNN(model, args.model, args.img_folder, args.index, args.n_lists, args.n_probe, args.knn_cache,
+                       feature_cache=args.feature_cache, storage=args.storage)
+
+    def classify(imgs: np.ndarray) -> np.ndarray:
+        return knn.predict(model.predict_on_batch(imgs))
+
+    batcher = MicroBatcher(classify, args.max_batch, args.max_wait_ms)
+    server = KNNServer((args.host, args.port), makeHandler(batcher, img_size, listCategories(args.img_folder)))
+    print("Serving on http://%s:%d (POST /classify, GET /stats)" % (args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    parser = argparse.ArgumentParser(description='KNN classification service')
+    parser.add_argument('--model', dest="model", type=str, required=True,
+                        help='The trained encoder to load')
+    parser.add_argument('--images', dest="img_folder", type=str, required=True,
+                        help='Location of the reference images')
+    parser.add_argument('--index', dest="index", type=str, default='exact',
+                        help='Nearest neighbors search: exact or ivf (approximate)')
+    parser.add_argument('--n_lists', dest="n_lists", type=int, default=64,
+                        help='Number of clusters of the ivf index')
+    parser.add_argument('--n_probe', dest="n_probe", type=int, default=8,
+                        help='Number of clusters the ivf index searches')
+    parser.add_argument('--knn_cache', dest="knn_cache", type=str,
+                        help='Folder to save/load the fitted KNN')
+    parser.add_argument('--feature_cache', dest="feature_cache", type=str,
+                        default=os.path.join('data', 'cache', 'embeddings'),
+                        help='Folder of the per-image embeddings cache')
+    parser.add_argument('--storage', dest="storage", type=str, default='float32',
+                        help='Type of the KNN embeddings: float32, float16 or int8')
+    parser.add_argument('--host', dest="host", type=str, default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', dest="port", type=int, default=8080,
+                        help='Port to listen on')
+    parser.add_argument('--max_batch', dest="max_batch", type=int, default=32,
+                        help='Maximum micro-batch size')
+    parser.add_argument('--max_wait_ms', dest="max_wait_ms", type=float, default=5.,
+                        help='Maximum time to wait for a micro-batch to fill')
+
+    main(parser.parse_args())
@@ -11,27 +11,59 @@ Project: https://github.com/aymericdamien/TensorFlow-Examples/
 from __future__ import print_function
 
 import argparse
+import collections
+import contextlib
+import csv
 import datetime
+import json
 import os
+import queue
+import threading
+import time
 from dataclasses import dataclass
 
-import cv2
 import numpy as np
-import tensorflow as tf
+import tensorflow.compat.v1 as tf
+import tensorflow.compat.v2 as tf2
 
 import CNN
 from Perceptron import Perceptron
-from SimpleAnn import SimpleAnn
+from SimpleAnn import SimpleAnn, parseLayers
+from utils import cacheKey, createCacheArray, decodeImages, listCategories, listCategoryImages, loadCache, saveCache
 
 USE_GPU = False
+# The original all dense ANN, 1024x16384 and 16384x4096 weights for a 32x32 input
+DEFAULT_ANN_LAYERS = '16384,4096,4096,1024,256'
 
 
 @dataclass
 class Datapack:
+    """
+    A view over a (possibly memory-mapped) dataset, the samples of the view are given by row indices,
+    so splitting and batching never copy the full data.
+    """
     images: np.ndarray
     labels: np.ndarray
+    indices: np.ndarray = None
     batch_index = 0
 
+    def __post_init__(self):
+        if self.indices is None:
+            self.indices = np.arange(len(self.labels))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def take(self, idx) -> (np.ndarray, np.ndarray):
+        """
+        Gathers samples of the view into memory
+        :param idx: Positions in the view (slice or index array)
+        :return: images, labels
+        """
+        # Sorted rows keep the reads from a memory-map sequential
+        rows = np.sort(self.indices[idx])
+        return self.images[rows], self.labels[rows]
+
     def next_batch(self, n_batch: int, advance: bool = True) -> (np.ndarray, np.ndarray):
         """
         Gets the next batch of data
@@ -41,105 +73,336 @@ class Datapack:
         """
         if n_batch < 0:
             self.batch_index = 0
-            n_batch = len(self.images)
+            n_batch = len(self)
 
-        if self.batch_index + n_batch >= len(self.images):
+        if self.batch_index + n_batch >= len(self):
             self.batch_index = 0
 
-        mini_batch = (self.images[self.batch_index:self.batch_index + n_batch, :],
-                      self.labels[self.batch_index:self.batch_index + n_batch, :])
+        mini_batch = self.take(slice(self.batch_index, self.batch_index + n_batch))
         if advance:
             self.batch_index = self.batch_index + n_batch
         return mini_batch
 
 
-def splitData(data: Datapack, ratio: float = 0.7) -> (Datapack, Datapack):
+class BatchPrefetcher(object):
     """
-    Splits the data to train/test
-    :param data: The data
-    :param ratio: The size of train in percentage
-    :return: Train, Test
+    Produces the training batches of a Datapack on a background thread. Every epoch is a new permutation
+    of the pack's rows (the last batch of an epoch may be smaller), the batches are gathered into a ring of
+    queue_size + 2 preallocated buffers and handed over through a bounded queue, so the session never waits
+    for the slicing. A batch is valid until the next call to next_batch.
     """
-    imgs = data.images
-    lbls = data.labels
-    n_data = len(lbls)
 
-    idx = [x for x in range(n_data)]
-    np.random.shuffle(idx)
+    def __init__(self, data: Datapack, n_batch: int, queue_size: int = 4, seed: int = None):
+        self.data = data
+        self.n_batch = min(n_batch, len(data))
+        n_buffers = queue_size + 2
+        self.images = np.empty((n_buffers, self.n_batch) + data.images.shape[1:], dtype=data.images.dtype)
+        self.labels = np.empty((n_buffers, self.n_batch) + data.labels.shape[1:], dtype=data.labels.dtype)
+        self._free = queue.Queue()
+        for buf in range(n_buffers):
+            self._free.put(buf)
+        self._ready = queue.Queue(maxsize=queue_size)
+        self._in_use = None
+        self._error = None
+        self._stop = threading.Event()
+        self._rng = np.random.RandomState(seed)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _get(self, q: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _put(self, q: queue.Queue, item):
+        while not self._stop.is_set():
+            try:
+                return q.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                order = self.data.indices[self._rng.permutation(len(self.data))]
+                for start in range(0, len(order), self.n_batch):
+                    # Sorted rows keep the reads from a memory-map sequential
+                    rows = np.sort(order[start:start + self.n_batch])
+                    buf = self._get(self._free)
+                    if buf is None:
+                        return
+                    np.take(self.data.images, rows, axis=0, out=self.images[buf, :len(rows)])
+                    np.take(self.data.labels, rows, axis=0, out=self.labels[buf, :len(rows)])
+                    self._put(self._ready, (buf, len(rows)))
+        except Exception as e:
+            self._error = e
+            self._put(self._ready, (None, 0))
+
+    def next_batch(self) -> (np.ndarray, np.ndarray):
+        """
+        :return: The next batch of images, labels
+        """
+        if self._in_use is not None:
+            self._free.put(self._in_use)
+        buf, n = self._ready.get()
+        if buf is None:
+            raise self._error
+        self._in_use = buf
+        return self.images[buf, :n], self.labels[buf, :n]
 
-    imgs_shuff = imgs[idx, :]
-    lbls_shuff = lbls[idx]
+    def close(self):
+        self._stop.set()
+        self._thread.join()
 
-    split = int(n_data * ratio)
-    train = Datapack(imgs_shuff[:split, :], lbls_shuff[:split])
-    test = Datapack(imgs_shuff[split:, :], lbls_shuff[split:])
 
-    return train, test
+def writeScalars(summary_writer, values: dict, step: int):
+    """
+    Writes scalars to TensorBoard, with a TF1 FileWriter in graph mode or a TF2 summary writer in eager mode
+    :param summary_writer: The writer
+    :param values: tag -> value
+    :param step: The step
+    """
+    if tf.executing_eagerly():
+        with summary_writer.as_default():
+            for tag, value in values.items():
+                tf2.summary.scalar(tag, value, step=step)
+    else:
+        summary_writer.add_summary(
+            tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value) for tag, value in values.items()]), step)
 
 
-def preProcess(img):
+class StepTimer(object):
     """
-    Dose some simple pre-process to the images before they go into the NN
-    :param img: Original image
-    :return: Processed image
+    Opt-in timings of the training loop sections (batch fetch, train step, evaluation, checkpoint, summaries).
+    Disabled, time() is an empty context manager.
     """
-    img = cv2.resize(img, (32, 32))
-    img = img / 255.0
-    # thrs = 0.5
-    # img[img < thrs] = 0
-    # img[img >= thrs] = 1
 
-    return img
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        # (step, section, seconds)
+        self.records = []
+        self._written = 0
+
+    @contextlib.contextmanager
+    def time(self, section: str, step: int):
+        if not self.enabled:
+            yield
+            return
+        start_t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.records.append((step, section, time.perf_counter() - start_t))
+
+    @staticmethod
+    def _stats(records: list) -> dict:
+        totals = collections.OrderedDict()
+        counts = collections.Counter()
+        for _, section, seconds in records:
+            totals[section] = totals.get(section, 0.) + seconds
+            counts[section] += 1
+        all_time = sum(totals.values()) or 1.
+        return {x: {'count': counts[x], 'total_s': totals[x], 'mean_ms': 1000 * totals[x] / counts[x],
+                    'share': totals[x] / all_time} for x in totals}
+
+    def writeSummaries(self, summary_writer, step: int):
+        """
+        Writes the mean time and the share of the loop time of every section since the last call
+        """
+        if not self.enabled:
+            return
+        stats = self._stats(self.records[self._written:])
+        self._written = len(self.records)
+        values = collections.OrderedDict()
+        for section, stat in stats.items():
+            values['Profile/%s_ms' % section] = stat['mean_ms']
+            values['Profile/%s_share' % section] = stat['share']
+        writeScalars(summary_writer, values, step)
+
+    def save(self, folder: str):
+        """
+        Writes the per-step trace (profile.csv) and the per-section totals (profile.json)
+        """
+        if not self.enabled:
+            return
+        with open(os.path.join(folder, 'profile.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['step', 'section', 'seconds'])
+            writer.writerows(self.records)
+        stats = self._stats(self.records)
+        with open(os.path.join(folder, 'profile.json'), 'w') as f:
+            json.dump(stats, f, indent=2)
+        for section, stat in stats.items():
+            print("\t%s:\t%.3f ms/call,\t%.1f%% of the loop time" % (section, stat['mean_ms'], 100 * stat['share']))
+        print("Profile written to %s" % folder)
 
 
-def loadData(folder_path: str, class_cap: int = -1) -> (Datapack, dict):
+def splitData(data: Datapack, ratio: float = 0.7) -> (Datapack, Datapack):
     """
-    Load the data from the data path.
-    :param folder_path: Base folder for the data
+    Splits the data to train/test, both share the data of the original pack
+    :param data: The data
+    :param ratio: The size of train in percentage
+    :return: Train, Test
+    """
+    n_data = len(data)
+    idx = data.indices[np.random.permutation(n_data)]
+
+    split = int(n_data * ratio)
+    train = Datapack(data.images, data.labels, idx[:split])
+    test = Datapack(data.images, data.labels, idx[split:])
+
+    return train, test
+
+
+def loadData(folder_path: str, class_cap: int = -1, img_size: int = 32,
+             cache_dir: str = os.path.join('data', 'cache'), n_workers: int = None) -> (Datapack, dict):
+    """
+    Load the data from the data path. The images are decoded straight into a memory-mapped
+    cache file, so the data can be bigger than the RAM.
+    :param folder_path: Base folder for the data (category sub-folders or a shard folder)
     :param class_cap: Maximum samples from each category
+    :param img_size: The images are resized to img_size X img_size and flattened
+    :param cache_dir: Where to keep the preprocessed data between runs, None to keep it in memory
+    :param n_workers: Number of decoding processes, None for all cores
     :return: The data
     """
     print("Loading data...")
-    classes = os.listdir(folder_path)
+    classes = listCategories(folder_path)
     class2id = {x: i for i, x in enumerate(classes)}
 
-    images = []
-    labels = []
-    for clz in classes:
-        max_samp = class_cap
-        sam_count = 0
-        print('\t%s:\t' % clz, end='')
-        class_path = os.path.join(folder_path, clz)
-        for img_path in os.listdir(class_path):
-            img_full_path = os.path.join(class_path, img_path)
-
-            img = cv2.imread(img_full_path, cv2.IMREAD_GRAYSCALE)
-            img = preProcess(img)
-            img = img.reshape((1, -1))
-            images.append(img)
-            lbl_vec = np.zeros(len(classes))
-            lbl_vec[class2id[clz]] = 1
-            labels.append(lbl_vec)
-            sam_count += 1
-            max_samp -= 1
-            if max_samp == 0:
-                break
-
-        print(sam_count)
-
-    data = Datapack(
-        np.array(images, dtype=np.float32).squeeze(),
-        np.array(labels, dtype=np.uint8))
+    # The key stats every file of the folder, only worth it with a cache
+    key = None
+    if cache_dir is not None:
+        key = cacheKey(folder_path, loader='loadData', categories=classes, class_cap=class_cap, img_size=img_size)
+    cached = loadCache(cache_dir, key)
+    if cached is None:
+        img_paths = []
+        lbl_ids = []
+        for clz, clz_imgs in zip(*listCategoryImages(folder_path)):
+            if class_cap > 0:
+                clz_imgs = clz_imgs[:class_cap]
+            print('\t%s:\t%d' % (clz, len(clz_imgs)))
+            img_paths += clz_imgs
+            lbl_ids += [class2id[clz]] * len(clz_imgs)
+
+        images = createCacheArray(cache_dir, key, (len(img_paths), img_size ** 2))
+        _, valid = decodeImages(img_paths, img_size, n_workers=n_workers, out=images)
+        images /= 255.0
+
+        # Unreadable images are kept as empty rows without a label
+        labels = np.zeros((len(img_paths), len(classes)), dtype=np.uint8)
+        labels[np.flatnonzero(valid), np.array(lbl_ids, dtype=int)[valid]] = 1
+        images[~valid] = 0
+        saveCache(cache_dir, key, images, labels)
+        cached = loadCache(cache_dir, key) or (images, labels)
+    else:
+        print('\tLoaded from cache: %d samples' % len(cached[1]))
+
+    images, labels = cached
+    data = Datapack(images, labels, np.flatnonzero(labels.any(axis=1)))
     return data, class2id
 
 
-def build_and_run(nn, n_input: int, n_classes: int,
-                  train: Datapack, test: Datapack,
-                  n_steps: int, n_batch: int):
+@dataclass
+class TrainGraph:
+    """
+    The placeholders and ops of the SLP/ANN training graph
+    """
+    X: tf.Tensor
+    Y: tf.Tensor
+    pred: tf.Tensor
+    loss_op: tf.Tensor
+    acc: tf.Tensor
+    loss_sum: tf.Tensor
+    n_correct: tf.Tensor
+    global_step: tf.Variable
+    learning_rate: tf.Tensor
+    train_op: tf.Operation
+    # Gradient accumulation only (accum_steps > 1), train_op then applies the accumulated gradients
+    accum_op: tf.Operation = None
+    zero_op: tf.Operation = None
+
+
+def graphBatches(data: Datapack, n_batch: int) -> (tf.Tensor, tf.Tensor, tf.Operation, dict):
+    """
+    Stages a Datapack into the graph once: the samples are kept in (non saved) variables, and every batch
+    is gathered in the graph from a tf.data pipeline of shuffled row indices, so the training steps do not
+    copy any data from Python.
+    :param data: The data
+    :param n_batch: Size of batch, the last batch of an epoch holds the remainder
+    :return: batch images, batch labels, the staging op and its feed_dict (run once, after the initializer)
+    """
+    images, labels = data.take(slice(None))
+    images_init = tf.placeholder(images.dtype, images.shape)
+    labels_init = tf.placeholder(labels.dtype, labels.shape)
+    images_var = tf.Variable(images_init, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                             name='staged_images')
+    labels_var = tf.Variable(labels_init, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                             name='staged_labels')
+    stage_op = tf.group(images_var.initializer, labels_var.initializer)
+
+    rows = tf.data.Dataset.range(len(images)).shuffle(len(images)).batch(n_batch).repeat().prefetch(2)
+    batch_rows = tf.data.make_one_shot_iterator(rows).get_next()
+    batch_x = tf.cast(tf.gather(images_var, batch_rows), tf.float32)
+    batch_y = tf.cast(tf.gather(labels_var, batch_rows), tf.float32)
+    return batch_x, batch_y, stage_op, {images_init: images, labels_init: labels}
+
+
+def accumulateGradients(optimizer: tf.train.Optimizer, loss_sum: tf.Tensor, n_samples: tf.Tensor,
+                        global_step: tf.Variable) -> (tf.Operation, tf.Operation, tf.Operation):
+    """
+    Gradient accumulation over micro-batches, for large batches in bounded memory: only one micro-batch of
+    activations is alive at a time, plus one (non saved) accumulator per trainable variable.
+    The summed loss is accumulated, so the applied gradient is the exact mean over all the accumulated samples
+    (a smaller remainder micro-batch weighs less).
+    :param optimizer: The optimizer
+    :param loss_sum: The summed loss of a micro-batch
+    :param n_samples: The micro-batch size
+    :param global_step: Incremented once per applied update
+    :return: accum_op (adds a micro-batch), zero_op (resets the accumulators, run once after the initializer),
+             apply_op (updates the variables with the mean gradient, then resets the accumulators)
+    """
+    train_vars = tf.trainable_variables()
+    accums = [tf.Variable(tf.zeros(x.shape, x.dtype.base_dtype), trainable=False,
+                          collections=[tf.GraphKeys.LOCAL_VARIABLES], name='accum') for x in train_vars]
+    count = tf.Variable(0., trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name='accum_count')
+    zero_op = tf.variables_initializer(accums + [count])
+
+    grads = tf.gradients(loss_sum, train_vars)
+    accum_op = tf.group(*[acc.assign_add(grad) for acc, grad in zip(accums, grads)],
+                        count.assign_add(tf.cast(n_samples, tf.float32)))
+
+    mean_grads = [acc / tf.maximum(count, 1.) for acc in accums]
+    update_op = optimizer.apply_gradients(zip(mean_grads, train_vars), global_step=global_step)
+    with tf.control_dependencies([update_op]):
+        apply_op = tf.group(*[acc.assign(tf.zeros_like(acc)) for acc in accums], count.assign(0.))
+    return accum_op, zero_op, apply_op
+
+
+def buildGraph(nn, n_input: int, n_classes: int, decay_steps: int, inputs: tuple = None,
+               accum_steps: int = 1) -> TrainGraph:
+    """
+    Builds the training graph of a network in the default graph
+    :param nn: The network, maps the input placeholder to the logits
+    :param n_input: The input size
+    :param n_classes: Number of classes
+    :param decay_steps: Steps between the learning rate decays
+    :param inputs: Optional (images, labels) batch tensors the graph reads when X and Y are not fed
+    :param accum_steps: Number of micro-batches per update, above 1 the gradients are summed by accum_op
+                        and applied (averaged over the samples) by train_op
+    :return: The graph ops
+    """
     # Construct model
     # tf Graph input
-    X = tf.placeholder("float", [None, n_input])
-    Y = tf.placeholder("float", [None, n_classes])
+    if inputs is None:
+        X = tf.placeholder("float", [None, n_input])
+        Y = tf.placeholder("float", [None, n_classes])
+    else:
+        X = tf.placeholder_with_default(inputs[0], [None, n_input])
+        Y = tf.placeholder_with_default(inputs[1], [None, n_classes])
     logits = nn(X)
 
     # TensorBoard
@@ -151,10 +414,12 @@ def build_and_run(nn, n_input: int, n_classes: int,
     with tf.name_scope('Loss'):
         # Minimize error using cross entropy
 
-        regularizer = tf.contrib.layers.l1_regularizer(scale=0.000001)
+        # L1 regularization (tf.contrib.layers.l1_regularizer is not in TF2)
         reg_variables = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
-        reg_term = tf.contrib.layers.apply_regularization(regularizer, reg_variables)
-        loss_op = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(logits=logits, labels=Y))
+        reg_term = 0.000001 * tf.add_n([tf.reduce_sum(tf.abs(x)) for x in reg_variables])
+        losses = tf.nn.softmax_cross_entropy_with_logits_v2(logits=logits, labels=Y)
+        loss_op = tf.reduce_mean(losses)
+        loss_sum = tf.reduce_sum(losses)
         # loss_op += reg_term # Adds the regularization loss
     with tf.name_scope('SGD'):
         # Gradient Descent1
@@ -162,22 +427,63 @@ def build_and_run(nn, n_input: int, n_classes: int,
         global_step = tf.Variable(0, trainable=False)
         learning_rate = tf.train.exponential_decay(starter_learning_rate,
                                                    global_step,
-                                                   epoch_steps * 40, .5, staircase=True)
-        train_op = tf.train.GradientDescentOptimizer(learning_rate).minimize(loss_op, global_step=global_step)
+                                                   decay_steps, .5, staircase=True)
+        optimizer = tf.train.GradientDescentOptimizer(learning_rate)
+        accum_op = zero_op = None
+        if accum_steps > 1:
+            accum_op, zero_op, train_op = accumulateGradients(optimizer, loss_sum, tf.shape(X)[0], global_step)
+        else:
+            train_op = optimizer.minimize(loss_op, global_step=global_step)
     with tf.name_scope('Accuracy'):
         # Accuracy
-        acc = tf.equal(tf.argmax(pred, 1), tf.argmax(Y, 1))
-        acc = tf.reduce_mean(tf.cast(acc, tf.float32))
+        correct = tf.equal(tf.argmax(pred, 1), tf.argmax(Y, 1))
+        acc = tf.reduce_mean(tf.cast(correct, tf.float32))
+        n_correct = tf.reduce_sum(tf.cast(correct, tf.int64))
+
+    return TrainGraph(X, Y, pred, loss_op, acc, loss_sum, n_correct, global_step, learning_rate, train_op,
+                      accum_op, zero_op)
+
+
+def evaluate(sess: tf.Session, graph: TrainGraph, data: Datapack, chunk_size: int) -> (float, float):
+    """
+    Accuracy and mean loss over a whole dataset, fed in chunks so the memory does not depend on the data size
+    :param sess: The session
+    :param graph: The graph ops
+    :param data: The data
+    :param chunk_size: Samples per sess.run
+    :return: accuracy, loss
+    """
+    loss_sum = 0.
+    n_correct = 0
+    for start in range(0, len(data), chunk_size):
+        x, y = data.take(slice(start, start + chunk_size))
+        chunk_loss, chunk_correct = sess.run([graph.loss_sum, graph.n_correct], feed_dict={graph.X: x, graph.Y: y})
+        loss_sum += float(chunk_loss)
+        n_correct += int(chunk_correct)
+    n_data = max(len(data), 1)
+    return n_correct / n_data, loss_sum / n_data
+
+
+def evalScalars(acc: float, loss: float, learning_rate: float) -> dict:
+    return collections.OrderedDict([('Accuracy', acc), ('Loss', loss), ('Learning_Rate', learning_rate)])
+
+
+def build_and_run(nn, n_input: int, n_classes: int,
+                  train: Datapack, test: Datapack,
+                  n_steps: int, n_batch: int, profile: bool = False, eval_batch: int = 1024, prefetch: int = 4,
+                  input_mode: str = 'feed', accum_steps: int = 1):
+    inputs = None
+    if input_mode == 'graph':
+        batch_x, batch_y, stage_op, stage_feed = graphBatches(train, n_batch)
+        inputs = (batch_x, batch_y)
+    # epoch_steps counts updates, so the learning rate decay follows the effective steps
+    graph = buildGraph(nn, n_input, n_classes, epoch_steps * 40, inputs, accum_steps)
+    X, Y = graph.X, graph.Y
+    train_op, learning_rate = graph.train_op, graph.learning_rate
 
     # Initialize the variables (i.e. assign their default value)
     init = tf.global_variables_initializer()
 
-    # Create a summary to monitor accuracy tensor
-    tf.summary.scalar("Accuracy", acc)
-    tf.summary.scalar("Loss", loss_op)
-    tf.summary.scalar("Learning Rate", learning_rate)
-    merged_summary = tf.summary.merge_all()
-
     # Logging
     tf_logs_path = os.path.join(os.getcwd(), 'tf_logs', args.model , datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
     os.makedirs(os.path.join(tf_logs_path, "train"), exist_ok=True)
@@ -198,54 +504,229 @@ def build_and_run(nn, n_input: int, n_classes: int,
 
         # Run the initializer
         sess.run(init)
+        if input_mode == 'graph':
+            sess.run(stage_op, feed_dict=stage_feed)
+            stage_feed = None
+        if graph.zero_op is not None:
+            sess.run(graph.zero_op)
 
         if args.weights_path:
             # Restore model weights from previously saved model
             saver.restore(sess, args.weights_path)
             print("Model restored from file: %s" % args.weights_path)
 
+        timer = StepTimer(profile)
+        batches = BatchPrefetcher(train, n_batch, prefetch) if input_mode == 'feed' else None
+        # With gradient accumulation every step runs accum_steps micro-batches, then a single update
+        micro_op = train_op if graph.accum_op is None else graph.accum_op
         epoch_count = 0
         for step in range(1, n_steps + 1):
-            batch_x, batch_y = train.next_batch(n_batch)
-            # Run optimization op (backprop)
-            c = sess.run(train_op,
-                         feed_dict={X: batch_x,
-                                    Y: batch_y})
+            for _ in range(accum_steps):
+                if batches is None:
+                    # The batch comes from the staged data in the graph
+                    with timer.time('train_step', step):
+                        sess.run(micro_op)
+                else:
+                    with timer.time('batch_fetch', step):
+                        batch_x, batch_y = batches.next_batch()
+                    # Run optimization op (backprop)
+                    with timer.time('train_step', step):
+                        sess.run(micro_op,
+                                 feed_dict={X: batch_x,
+                                            Y: batch_y})
+            if graph.accum_op is not None:
+                with timer.time('apply_grads', step):
+                    sess.run(train_op)
 
             if step % epoch_steps == 0 or step == 1:
-                save_path = saver.save(sess, checkpoint_path, global_step=epoch_count)
-
-                if USE_GPU and not GPU_FULL:
-                    train_x, train_y = train.next_batch(n_batch, False)
-                    test_x, test_y = test.next_batch(n_batch)
-                else:
-                    train_x, train_y = train.next_batch(-1)
-                    test_x, test_y = test.next_batch(-1)
-
-                train_acc, train_loss, summary_train = sess.run([acc, loss_op, merged_summary],
-                                                                feed_dict={X: train_x,
-                                                                           Y: train_y})
-                summary_writer_train.add_summary(summary_train, step)
-
-                test_acc, test_loss, summary_test = sess.run([acc, loss_op, merged_summary],
-                                                             feed_dict={X: test_x,
-                                                                        Y: test_y})
-                summary_writer_test.add_summary(summary_test, step)
+                with timer.time('checkpoint', step):
+                    save_path = saver.save(sess, checkpoint_path, global_step=epoch_count)
+
+                with timer.time('eval', step):
+                    # Streams the full sets in chunks, the sums are exact for any chunk size
+                    train_acc, train_loss = evaluate(sess, graph, train, eval_batch)
+                    test_acc, test_loss = evaluate(sess, graph, test, eval_batch)
+                    lr = float(sess.run(learning_rate))
+                with timer.time('summary', step):
+                    writeScalars(summary_writer_train, evalScalars(train_acc, train_loss, lr), step)
+                    writeScalars(summary_writer_test, evalScalars(test_acc, test_loss, lr), step)
+                timer.writeSummaries(summary_writer_train, step)
                 # Calculate batch loss and accuracy
                 print("Epoch " + str(epoch_count)
                       + ",\t Training Accuracy= " + "{:.6f}".format(train_acc)
                       + ",\t Loss= " + "{:.6f}".format(train_loss)
                       + ",\t Test Accuracy= " + "{:.6f}".format(test_acc)
                       + ",\t Loss= " + "{:.6f}".format(test_loss)
-                      + ",\t Learning Rate= " + str(learning_rate.eval()))
+                      + ",\t Learning Rate= " + str(lr))
                 epoch_count += 1
 
+        if batches is not None:
+            batches.close()
         print("Optimization Finished!")
+        timer.save(tf_logs_path)
 
         # Calculate accuracy for the Cloud dataset test images
-        print("Testing Accuracy:",
-              sess.run(acc, feed_dict={X: test.images,
-                                       Y: test.labels}))
+        print("Testing Accuracy:", evaluate(sess, graph, test, eval_batch)[0])
+
+
+class EagerTrainer(object):
+    """
+    The TF2 counterpart of TrainGraph: tf.function compiled train and eval steps of a Perceptron/SimpleAnn,
+    with the same loss, plain SGD and staircase learning rate decay as buildGraph
+    """
+
+    def __init__(self, net, decay_steps: int, jit_compile: bool = False):
+        """
+        :param net: Perceptron or SimpleAnn, built in eager mode
+        :param decay_steps: Steps between the learning rate decays
+        :param jit_compile: True to compile the steps with XLA
+        """
+        self.net = net
+        self.variables = net.variables()
+        self.decay_steps = decay_steps
+        self.global_step = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self.images = self.labels = None
+        self.train_step = tf2.function(self._trainStep, jit_compile=jit_compile)
+        self.train_rows = tf2.function(self._trainRows, jit_compile=jit_compile)
+        self.eval_step = tf2.function(self._evalStep, jit_compile=jit_compile)
+
+    def learningRate(self) -> tf.Tensor:
+        decays = tf.floor(tf.cast(self.global_step, tf.float32) / self.decay_steps)
+        return 0.5 * tf.pow(0.5, decays)
+
+    def _trainStep(self, x, y):
+        x = tf.cast(x, tf.float32)
+        y = tf.cast(y, tf.float32)
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(logits=self.net.getModel(x), labels=y))
+        grads = tape.gradient(loss, self.variables)
+        learning_rate = self.learningRate()
+        for var, grad in zip(self.variables, grads):
+            var.assign_sub(learning_rate * grad)
+        self.global_step.assign_add(1)
+        return loss
+
+    def _trainRows(self, rows):
+        return self._trainStep(tf.gather(self.images, rows), tf.gather(self.labels, rows))
+
+    def _evalStep(self, x, y):
+        x = tf.cast(x, tf.float32)
+        y = tf.cast(y, tf.float32)
+        logits = self.net.getModel(x)
+        loss_sum = tf.reduce_sum(tf.nn.softmax_cross_entropy_with_logits_v2(logits=logits, labels=y))
+        n_correct = tf.reduce_sum(tf.cast(tf.equal(tf.argmax(logits, 1), tf.argmax(y, 1)), tf.int64))
+        return loss_sum, n_correct
+
+    def stage(self, data: Datapack, n_batch: int):
+        """
+        Keeps a Datapack on the device, train_rows then gathers the batches from it (see graphBatches)
+        :return: An iterator over the rows of the shuffled batches
+        """
+        images, labels = data.take(slice(None))
+        self.images = tf.Variable(images, trainable=False)
+        self.labels = tf.Variable(labels, trainable=False)
+        rows = tf.data.Dataset.range(len(images)).shuffle(len(images)).batch(n_batch).repeat().prefetch(2)
+        return iter(rows)
+
+    def evaluate(self, data: Datapack, chunk_size: int) -> (float, float):
+        """
+        Accuracy and mean loss over a whole dataset, fed in chunks (see evaluate)
+        """
+        loss_sum = 0.
+        n_correct = 0
+        for start in range(0, len(data), chunk_size):
+            chunk_loss, chunk_correct = self.eval_step(*data.take(slice(start, start + chunk_size)))
+            loss_sum += float(chunk_loss)
+            n_correct += int(chunk_correct)
+        n_data = max(len(data), 1)
+        return n_correct / n_data, loss_sum / n_data
+
+
+def build_and_run_eager(net, train: Datapack, test: Datapack, n_steps: int, n_batch: int, profile: bool = False,
+                        eval_batch: int = 1024, prefetch: int = 4, input_mode: str = 'feed', jit: bool = False):
+    """
+    The TF2 version of build_and_run, the checkpoints are TF2 object checkpoints
+    """
+    trainer = EagerTrainer(net, epoch_steps * 40, jit)
+
+    # Logging
+    tf_logs_path = os.path.join(os.getcwd(), 'tf_logs', args.model, datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+    summary_writer_train = tf2.summary.create_file_writer(os.path.join(tf_logs_path, "train"))
+    summary_writer_test = tf2.summary.create_file_writer(os.path.join(tf_logs_path, "test"))
+
+    # Checkpoints
+    checkpoint = tf2.train.Checkpoint(step=trainer.global_step,
+                                      **{'var_%d' % i: x for i, x in enumerate(trainer.variables)})
+    manager = tf2.train.CheckpointManager(checkpoint, os.path.join(tf_logs_path, "checkpoints"), max_to_keep=5)
+    if args.weights_path:
+        checkpoint.restore(args.weights_path)
+        print("Model restored from file: %s" % args.weights_path)
+
+    timer = StepTimer(profile)
+    batches = BatchPrefetcher(train, n_batch, prefetch) if input_mode == 'feed' else None
+    rows = trainer.stage(train, n_batch) if input_mode == 'graph' else None
+    epoch_count = 0
+    for step in range(1, n_steps + 1):
+        if batches is None:
+            with timer.time('train_step', step):
+                trainer.train_rows(next(rows))
+        else:
+            with timer.time('batch_fetch', step):
+                batch_x, batch_y = batches.next_batch()
+            with timer.time('train_step', step):
+                trainer.train_step(batch_x, batch_y)
+
+        if step % epoch_steps == 0 or step == 1:
+            with timer.time('checkpoint', step):
+                manager.save(checkpoint_number=epoch_count)
+
+            with timer.time('eval', step):
+                train_acc, train_loss = trainer.evaluate(train, eval_batch)
+                test_acc, test_loss = trainer.evaluate(test, eval_batch)
+                lr = float(trainer.learningRate())
+            with timer.time('summary', step):
+                writeScalars(summary_writer_train, evalScalars(train_acc, train_loss, lr), step)
+                writeScalars(summary_writer_test, evalScalars(test_acc, test_loss, lr), step)
+            timer.writeSummaries(summary_writer_train, step)
+            print("Epoch " + str(epoch_count)
+                  + ",\t Training Accuracy= " + "{:.6f}".format(train_acc)
+                  + ",\t Loss= " + "{:.6f}".format(train_loss)
+                  + ",\t Test Accuracy= " + "{:.6f}".format(test_acc)
+                  + ",\t Loss= " + "{:.6f}".format(test_loss)
+                  + ",\t Learning Rate= " + str(lr))
+            epoch_count += 1
+
+    if batches is not None:
+        batches.close()
+    print("Optimization Finished!")
+    timer.save(tf_logs_path)
+
+    print("Testing Accuracy:", trainer.evaluate(test, eval_batch)[0])
+
+
+def makeNet(model: str, num_input: int, num_classes: int, ann_layers: str = None):
+    """
+    :param model: SLP or ANN
+    :param ann_layers: Hidden layers spec of the ANN (see SimpleAnn.parseLayers), the dense layers below if not set
+    :return: The network (Perceptron or SimpleAnn), its getModel maps the input to the logits
+    """
+    if model == 'ANN':
+        hidden_lst, layer_types = parseLayers(ann_layers or DEFAULT_ANN_LAYERS)
+        sim_ann = SimpleAnn(
+            hidden_lst=hidden_lst,
+            input_num=num_input,
+            class_num=num_classes,
+            layer_types=layer_types
+        )
+        print("ANN parameters:", sim_ann.paramCount())
+        return sim_ann
+    elif model == 'SLP':
+        perceptron = Perceptron(
+            input_num=num_input,
+            class_num=num_classes)
+        return perceptron
+    print("Model not valid, use: [SLP,ANN,CNN]")
+    exit(1)
 
 
 def run(args: argparse.Namespace):
@@ -257,51 +738,57 @@ def run(args: argparse.Namespace):
 
     # Parameters
     global epoch_steps, epoch
-    epoch = len(train.images)
+    epoch = len(train)
     batch_size = min(epoch, args.mini_batch)
-    epoch_steps = (epoch // batch_size)
+    # A step (update) runs accum_steps batches, the last batch of an epoch holds the remainder
+    epoch_steps = -(-epoch // (batch_size * args.accum_steps))
     num_steps = 1000 * epoch_steps
     print("Steps:", num_steps)
+    if args.accum_steps > 1:
+        print("Effective batch size:", batch_size * args.accum_steps)
 
     # Network Parameters
     global num_classes, num_input
-    num_input = len(data.images[0])
+    num_input = data.images.shape[1]
     num_classes = len(class2id)
 
     print('Model:', args.model)
-    if args.model == 'ANN':
-        sim_ann = SimpleAnn(
-            hidden_lst=[
-                128 ** 2,
-                64 ** 2,
-                64 ** 2,
-                32 ** 2,
-                16 ** 2
-            ],
-            input_num=num_input,
-            class_num=num_classes
+    if args.model == 'CNN':
+        CNN.main()
+        exit(0)
+    # One TF2 install runs both paths: the TF1 style graph/session or the tf.function steps
+    if args.runtime == 'graph':
+        tf.disable_v2_behavior()
+    net = makeNet(args.model, num_input, num_classes, args.ann_layers)
+
+    if args.runtime == 'eager':
+        build_and_run_eager(
+            net,
+            train=train,
+            test=test,
+            n_steps=num_steps,
+            n_batch=batch_size,
+            profile=args.profile,
+            eval_batch=args.eval_batch,
+            prefetch=max(1, args.prefetch),
+            input_mode=args.input_mode,
+            jit=args.jit,
         )
-        net = sim_ann.getModel
-    elif args.model == 'SLP':
-        perceptron = Perceptron(
-            input_num=num_input,
-            class_num=num_classes)
-        net = perceptron.getModel
-    elif args.model == 'CNN':
-            CNN.main()
-            exit(0)
-    else:
-        print("Model not valid, use: [SLP,ANN,CNN]")
-        exit(1)
+        return
 
     build_and_run(
-        net,
+        net.getModel,
         n_input=num_input,
         n_classes=num_classes,
         train=train,
         test=test,
         n_steps=num_steps,
         n_batch=batch_size,
+        profile=args.profile,
+        eval_batch=args.eval_batch,
+        prefetch=max(1, args.prefetch),
+        input_mode=args.input_mode,
+        accum_steps=args.accum_steps,
     )
 
 
@@ -317,14 +804,37 @@ if __name__ == "__main__":
                         help='How many samples to load from each catagory')
     parser.add_argument('--use_gpu', dest="gpu", type=bool,
                         help='Use GPU?')
-    parser.add_argument('--gpu_full', dest="full_gpu", type=bool,
-                        help='Test on full test when using GPU?')
+    parser.add_argument('--eval_batch', dest="eval_batch", type=int, default=1024,
+                        help='Samples per evaluation chunk, the whole train/test sets are evaluated chunk by chunk')
     parser.add_argument('--weights', dest="weights_path", type=str,
                         help='Location of weights')
+    parser.add_argument('--input_mode', dest="input_mode", type=str, default='feed', choices=['feed', 'graph'],
+                        help='feed: batches fed with feed_dict, graph: the train set is staged once into the graph')
+    parser.add_argument('--ann_layers', dest="ann_layers", type=str,
+                        help=('Hidden layers of the ANN, comma separated SIZE[:dense|lowrank:RANK|'
+                              'blocksparse:BLOCK:DENSITY], default: %s' % DEFAULT_ANN_LAYERS))
+    parser.add_argument('--runtime', dest="runtime", type=str, default='graph', choices=['graph', 'eager'],
+                        help='graph: TF1 style session (tf.compat.v1), eager: TF2 tf.function train/eval steps')
+    parser.add_argument('--jit', dest="jit", action='store_true',
+                        help='Compile the eager runtime steps with XLA')
+    parser.add_argument('--accum_steps', dest="accum_steps", type=int, default=1,
+                        help=('Batches per update (gradient accumulation), the effective batch size is '
+                              'batch_size * accum_steps'))
+    parser.add_argument('--prefetch', dest="prefetch", type=int, default=4,
+                        help='Number of training batches prepared ahead on a background thread')
+    parser.add_argument('--profile', dest="profile", action='store_true',
+                        help='Record the time of every training loop section (TensorBoard and profile.csv/json)')
 
     args = parser.parse_args()
     USE_GPU = args.gpu
-    GPU_FULL = args.full_gpu
     args.mini_batch = max(1, args.mini_batch)
+    args.accum_steps = max(1, args.accum_steps)
+    if args.ann_layers:
+        try:
+            parseLayers(args.ann_layers)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.accum_steps > 1 and args.runtime == 'eager':
+        parser.error('--accum_steps is only supported by --runtime graph')
 
     run(args)
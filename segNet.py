@@ -14,27 +14,22 @@ from tensorflow.keras import layers
 from datetime import datetime
 import time
 
-from utils import prepareSegData
+from utils import prepareSegDataset
 
 NAME = "clouds recognition{}".format(int(time.time()))
 
 
-def main():
-    DATA_DIR = "data/train_images"
-    kLABEL_NUM = 4
-    img_size = img_h = img_w = 128
-    train_x, test_x, train_y, test_y = \
-        prepareSegData(
-            img_list_file='data/train.csv',
-            img_folder=DATA_DIR,
-            img_size=img_size,
-            sample_size=-10,
-            normalize=True)
-    epoch = len(train_x)
-
+def buildModel(img_size: int, n_labels: int, decay_steps: int) -> keras.Model:
+    """
+    Builds and compiles the segmentation encoder-decoder
+    :param img_size: The input height/width, a multiple of 16
+    :param n_labels: Number of output masks
+    :param decay_steps: Steps between the learning rate decays
+    :return: The compiled model
+    """
     # Network construction
     #   Encoder
-    input_img = layers.Input(shape=[img_h, img_w, 3])
+    input_img = layers.Input(shape=[img_size, img_size, 3])
     x = layers.Conv2D(32, (5, 5), strides=(2, 2), activation='relu', padding='same')(input_img)  # 64
     x = layers.Conv2D(64, (5, 5), strides=1, activation='relu', padding='same')(x)
     x = layers.Conv2D(64, (5, 5), strides=(2, 2), activation='relu', padding='same')(x)  # 32
@@ -50,20 +45,38 @@ def main():
     x = layers.Conv2D(128, (3, 3), strides=1, activation='relu', padding='same')(x)
     x = layers.Conv2DTranspose(128, (3, 3), strides=(2, 2), activation='relu', padding='same')(x)  # 64
     x = layers.Conv2D(64, (3, 3), strides=1, activation='relu', padding='same')(x)
-    decoder = layers.Conv2DTranspose(kLABEL_NUM, (3, 3), activation='relu', strides=(2, 2), padding='same')(x)  # 128
+    decoder = layers.Conv2DTranspose(n_labels, (3, 3), activation='relu', strides=(2, 2), padding='same')(x)  # 128
 
     model = keras.Model(input_img, decoder)
 
     initial_learning_rate_main = 1e-5
     lr_schedule_main = keras.optimizers.schedules.ExponentialDecay(
         initial_learning_rate_main,
-        decay_steps=epoch * 10,
+        decay_steps=decay_steps,
         decay_rate=1e-1,
         staircase=True)
 
     model.compile(optimizer=tf.keras.optimizers.Adam(),  # learning_rate=lr_schedule_main),
                   loss=tf.keras.losses.mse,
                   metrics=['accuracy'])
+    return model
+
+
+def main():
+    DATA_DIR = "data/train_images"
+    kLABEL_NUM = 4
+    img_size = img_h = img_w = 128
+    train_ds, test_ds, epoch = \
+        prepareSegDataset(
+            img_list_file='data/train.csv',
+            img_folder=DATA_DIR,
+            img_size=img_size,
+            sample_size=-10,
+            normalize=True,
+            batch_size=64)
+    test_x, test_y = [x.numpy() for x in next(iter(test_ds))]
+
+    model = buildModel(img_size, kLABEL_NUM, decay_steps=epoch * 10)
 
     log_dir = os.path.join("tf_logs", "SegNet", datetime.now().strftime("%Y%m%d-%H%M%S/"))
     tensorboard_callback = keras.callbacks.TensorBoard(log_dir=log_dir, profile_batch=0)
@@ -111,12 +124,9 @@ def main():
     # Define the per-epoch callback.
     cm_callback = keras.callbacks.LambdaCallback(on_epoch_end=log_img_pred)
 
-    model.fit(x=train_x,
-              y=train_y,
-              batch_size=64,
+    model.fit(train_ds,
               epochs=200,
-              use_multiprocessing=True,
-              validation_data=(test_x, test_y),
+              validation_data=test_ds,
               callbacks=[tensorboard_callback,
                          save_callback,
                          cm_callback
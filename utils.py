@@ -1,4 +1,8 @@
+import hashlib
+import json
 import os
+from multiprocessing import Pool
+
 import cv2
 import numpy as np
 from tqdm import tqdm
@@ -39,7 +43,115 @@ def NOT_SK_LEARN_train_test_split(
     return train_x, test_x, train_y, test_y
 
 
-def rle_to_mask(rle_string: str, width: int, height: int, norm=False) -> np.ndarray:
+def _rleRuns(rle_string: str) -> (np.ndarray, np.ndarray):
+    """
+    Parses an RLE string to 0-based run starts and run ends.
+    """
+    rle_numbers = np.array(rle_string.split(), dtype=np.int64)
+    starts = rle_numbers[0::2] - 1
+    return starts, starts + rle_numbers[1::2]
+
+
+def _rleDecode(rle_string: str, n_pixels: int, lbl_val) -> np.ndarray:
+    """
+    Decodes an RLE string to a flat (column major) uint8 mask. The run boundaries split the mask into
+    alternating background/run segments, which np.repeat expands in a single pass.
+    """
+    starts, ends = _rleRuns(rle_string)
+    bounds = np.empty(2 * len(starts) + 2, dtype=np.int64)
+    bounds[0] = 0
+    bounds[1:-1:2] = starts
+    bounds[2:-1:2] = ends
+    bounds[-1] = n_pixels
+
+    seg_vals = np.zeros(len(bounds) - 1, dtype=np.uint8)
+    seg_vals[1::2] = lbl_val
+    return np.repeat(seg_vals, np.diff(bounds))
+
+
+def _isEmptyRle(rle_string) -> bool:
+    return not isinstance(rle_string, str) or not rle_string.strip()
+
+
+def _rleSegments(rle_string: str, height: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Splits the runs of an RLE string at the column boundaries.
+    :return: column, first row, last row + 1 of every segment (sorted by column)
+    """
+    starts, ends = _rleRuns(rle_string)
+    first_col = starts // height
+    last_col = (ends - 1) // height
+    n_segs = last_col - first_col + 1
+
+    seg_run = np.repeat(np.arange(len(starts)), n_segs)
+    seg_col = first_col[seg_run] + np.arange(len(seg_run)) - np.repeat(np.cumsum(n_segs) - n_segs, n_segs)
+    seg_r0 = np.where(seg_col == first_col[seg_run], starts[seg_run] % height, 0)
+    seg_r1 = np.where(seg_col == last_col[seg_run], (ends[seg_run] - 1) % height + 1, height)
+    return seg_col, seg_r0, seg_r1
+
+
+def _rleAreaResize(rle_string: str, width: int, height: int, out_w: int, out_h: int) -> np.ndarray:
+    """
+    Rasterizes the runs straight onto a smaller grid, every output pixel gets the fraction of its area
+    that is covered by the mask (same as cv2.INTER_AREA on the full mask).
+    """
+    seg_col, seg_r0, seg_r1 = _rleSegments(rle_string, height)
+    s_x = out_w / width
+    s_y = out_h / height
+
+    # A source column covers [col * s_x, (col + 1) * s_x), at most two output columns when down-scaling
+    x0 = seg_col * s_x
+    x1 = x0 + s_x
+    j0 = np.floor(x0).astype(np.int64)
+    w0 = np.minimum(x1, j0 + 1) - x0
+    w1 = np.maximum(x1 - (j0 + 1), 0)
+    seg_j = np.concatenate([j0, np.minimum(j0 + 1, out_w - 1)])
+    seg_w = np.concatenate([w0, w1])
+    a = np.tile(seg_r0 * s_y, 2)
+    b = np.tile(seg_r1 * s_y, 2)
+
+    # Partial coverage at the first/last output row of every segment, the rows in between are
+    # fully covered and are added with +w/-w marks and a cumulative sum
+    ia = np.floor(a).astype(np.int64)
+    ib = np.floor(b).astype(np.int64)
+    multi = ib > ia
+    n_cells = (out_h + 1) * out_w
+    cover = np.bincount(ia * out_w + seg_j, weights=(np.minimum(b, ia + 1) - a) * seg_w, minlength=n_cells)
+    cover += np.bincount(ib[multi] * out_w + seg_j[multi], weights=(b - ib)[multi] * seg_w[multi],
+                         minlength=n_cells)
+    marks = np.bincount((ia + 1)[multi] * out_w + seg_j[multi], weights=seg_w[multi], minlength=n_cells)
+    marks -= np.bincount(ib[multi] * out_w + seg_j[multi], weights=seg_w[multi], minlength=n_cells)
+    cover += np.cumsum(marks.reshape(out_h + 1, out_w), axis=0).ravel()
+    return cover.reshape(out_h + 1, out_w)[:out_h]
+
+
+def _rleNearestResize(rle_string: str, width: int, height: int, out_w: int, out_h: int) -> np.ndarray:
+    """
+    Rasterizes the runs straight onto a new grid, sampling the source pixel of every output pixel
+    (same as cv2.INTER_NEAREST on the full mask).
+    """
+    seg_col, seg_r0, seg_r1 = _rleSegments(rle_string, height)
+    # The inverse of the scale factor as cv2 computes it, width / out_w rounds differently at some columns
+    src_cols = np.minimum(np.floor(np.arange(out_w) * (1 / (out_w / width))).astype(np.int64), width - 1)
+    src_rows = np.minimum(np.floor(np.arange(out_h) * (1 / (out_h / height))).astype(np.int64), height - 1)
+
+    # Pair every output column with the segments of its source column
+    seg_lo = np.searchsorted(seg_col, src_cols, 'left')
+    n_pairs = np.searchsorted(seg_col, src_cols, 'right') - seg_lo
+    pair_j = np.repeat(np.arange(out_w), n_pairs)
+    pair_seg = np.arange(len(pair_j)) - np.repeat(np.cumsum(n_pairs) - n_pairs - seg_lo, n_pairs)
+
+    # The output rows that sample inside a segment are a contiguous range
+    i_lo = np.searchsorted(src_rows, seg_r0[pair_seg], 'left')
+    i_hi = np.searchsorted(src_rows, seg_r1[pair_seg], 'left')
+    n_cells = (out_h + 1) * out_w
+    marks = np.bincount(i_lo * out_w + pair_j, minlength=n_cells)
+    marks -= np.bincount(i_hi * out_w + pair_j, minlength=n_cells)
+    return np.cumsum(marks.reshape(out_h + 1, out_w), axis=0)[:out_h] > 0
+
+
+def rle_to_mask(rle_string: str, width: int, height: int, norm=False, out_size: tuple = None,
+                interpolation: str = 'area') -> np.ndarray:
     """
     convert RLE(run length encoding) string to numpy array
 
@@ -47,96 +159,463 @@ def rle_to_mask(rle_string: str, width: int, height: int, norm=False) -> np.ndar
     rle_string (str): string of rle encoded mask
     height (int): height of the mask
     width (int): width of the mask
+    norm (bool): True for a {0, 1} mask, {0, 255} otherwise
+    out_size (tuple): optional (width, height) to rasterize the mask at, without decoding it at full size
+    interpolation (str): 'area' (float32 coverage, for down-scaling) or 'nearest' (uint8) when out_size is given
 
     Returns:
     numpy.array: numpy array of the mask
     """
 
-    rows, cols = height, width
-    lbl_val = 255.
-    if norm:
-        lbl_val = 1.
+    lbl_val = 1 if norm else 255
 
-    if rle_string == -1:
-        return np.zeros((height, width))
-    else:
-        rle_numbers = [int(num_string) for num_string in rle_string.split(' ')]
-        rle_pairs = np.array(rle_numbers).reshape(-1, 2)
-        img = np.zeros(rows * cols, dtype=np.uint8)
-        for index, length in rle_pairs:
-            index -= 1
-            img[index:index + length] = lbl_val
-        img = img.reshape(cols, rows)
-        img = img.T
-        return img
-
-
-def prepareData(img_folder: str = "data/mini_data", img_size: int = 32, sample_size=3000, normalize=False):
-    CATEGORIES = os.listdir(img_folder)
-    training_data = []
-    max_data_sampeles = min([len(x) for x in [os.listdir(os.path.join(img_folder, y)) for y in CATEGORIES]])
+    if out_size is not None and tuple(out_size) != (width, height):
+        out_w, out_h = out_size
+        if rle_string == -1 or _isEmptyRle(rle_string):
+            return np.zeros((out_h, out_w), dtype=np.float32 if interpolation == 'area' else np.uint8)
+        if interpolation == 'nearest':
+            return _rleNearestResize(rle_string, width, height, out_w, out_h).astype(np.uint8) * lbl_val
+        if interpolation != 'area':
+            raise ValueError("Unknown interpolation: %s" % interpolation)
+        if out_w > width or out_h > height:
+            mask = rle_to_mask(rle_string, width, height, norm).astype(np.float32)
+            return cv2.resize(mask, (out_w, out_h))
+        return (_rleAreaResize(rle_string, width, height, out_w, out_h) * lbl_val).astype(np.float32)
+
+    if rle_string == -1 or _isEmptyRle(rle_string):
+        return np.zeros((height, width), dtype=np.uint8)
+
+    img = _rleDecode(rle_string, height * width, lbl_val)
+    # The pixels are numbered top to bottom, then left to right
+    return img.reshape(width, height).T
+
+
+def rles_to_masks(rle_strings: list, width: int, height: int, norm=False, out: np.ndarray = None) -> np.ndarray:
+    """
+    Decodes many RLE strings (of the same image size) into one array
+    :param rle_strings: The RLE strings, -1/NaN/empty for an empty mask
+    :param width: width of the masks
+    :param height: height of the masks
+    :param norm: True for {0, 1} masks, {0, 255} otherwise
+    :param out: Optional preallocated (N, height, width) uint8 array
+    :return: (N, height, width) uint8 masks
+    """
+    lbl_val = 1 if norm else 255
+    if out is None:
+        out = np.empty((len(rle_strings), height, width), dtype=np.uint8)
+
+    for i, rle_string in enumerate(rle_strings):
+        if rle_string == -1 or _isEmptyRle(rle_string):
+            out[i] = 0
+            continue
+        out[i] = _rleDecode(rle_string, height * width, lbl_val).reshape(width, height).T
+    return out
+
+
+def mask_to_rle(mask: np.ndarray) -> str:
+    """
+    convert a mask to an RLE(run length encoding) string, the inverse of rle_to_mask
+
+    Parameters:
+    mask (numpy.array): (height, width) mask, non-zero pixels are encoded
+
+    Returns:
+    str: the rle string, empty for an empty mask
+    """
+    pixels = np.zeros(mask.size + 2, dtype=np.int8)
+    pixels[1:-1] = mask.T.ravel() != 0
+    runs = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    runs[1::2] -= runs[0::2]
+    return ' '.join(runs.astype(str))
+
+
+def folderSignature(folder: str) -> list:
+    """
+    Lists every file under a folder with its size and modification time, used to detect changes in the data.
+    :param folder: The folder to scan
+    :return: Sorted list of (relative path, size, mtime)
+    """
+    signature = []
+    for root, _, files in os.walk(folder):
+        for f_name in files:
+            f_path = os.path.join(root, f_name)
+            f_stat = os.stat(f_path)
+            signature.append((os.path.relpath(f_path, folder).replace(os.sep, '/'), f_stat.st_size,
+                              f_stat.st_mtime_ns))
+    signature.sort()
+    return signature
+
+
+def cacheKey(folder: str, **params) -> str:
+    """
+    Builds a key for a preprocessed dataset, any change to the folder's files or to the parameters changes the key.
+    :param folder: The source folder of the data
+    :param params: The preprocessing parameters
+    :return: Hex digest key
+    """
+    key_data = json.dumps([folderSignature(folder), params], sort_keys=True)
+    return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+
+def cachePaths(cache_dir: str, key: str) -> (str, str):
+    """
+    :return: The data and labels paths of a cache entry
+    """
+    return os.path.join(cache_dir, key + '_x.npy'), os.path.join(cache_dir, key + '_y.npy')
+
+
+def loadCache(cache_dir: str, key: str) -> (np.ndarray, np.ndarray):
+    """
+    Loads a cached dataset, the data is memory-mapped (read only) instead of read into memory.
+    :param cache_dir: The cache folder, None if caching is disabled
+    :param key: The entry key (see cacheKey)
+    :return: data, labels. None if there is no such entry
+    """
+    if cache_dir is None:
+        return None
+    x_path, y_path = cachePaths(cache_dir, key)
+    # The labels are written last, so they mark a complete entry
+    if not os.path.isfile(y_path):
+        return None
+    return np.load(x_path, mmap_mode='r'), np.load(y_path)
+
+
+def createCacheArray(cache_dir: str, key: str, shape: tuple, dtype=np.float32) -> np.ndarray:
+    """
+    Creates the data array of a cache entry as a writable memory-map, so a dataset can be built
+    straight on disk (see saveCache). Without a cache folder a regular in-memory array is returned.
+    :param cache_dir: The cache folder, None if caching is disabled
+    :param key: The entry key (see cacheKey)
+    :param shape: The data shape
+    :param dtype: The data type
+    :return: The (uninitialized) array
+    """
+    if cache_dir is None:
+        return np.empty(shape, dtype=dtype)
+    os.makedirs(cache_dir, exist_ok=True)
+    x_path, _ = cachePaths(cache_dir, key)
+    return np.lib.format.open_memmap(x_path + '.tmp.npy', mode='w+', dtype=dtype, shape=shape)
+
+
+def saveCache(cache_dir: str, key: str, X: np.ndarray, y: np.ndarray):
+    """
+    Stores a preprocessed dataset in the cache. Files are written to a temporary name and then moved,
+    so an interrupted run never leaves a broken entry.
+    :param cache_dir: The cache folder, None if caching is disabled
+    :param key: The entry key (see cacheKey)
+    :param X: The data, may be an array from createCacheArray
+    :param y: The labels
+    """
+    if cache_dir is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    for path, arr in zip(cachePaths(cache_dir, key), (X, y)):
+        tmp_path = path + '.tmp.npy'
+        if isinstance(arr, np.memmap) and os.path.abspath(arr.filename) == os.path.abspath(tmp_path):
+            arr.flush()
+        else:
+            np.save(tmp_path, arr)
+        os.replace(tmp_path, path)
+
+
+SHARD_INDEX = 'index.json'
+SHARD_SEP = '#'
+
+
+class ShardWriter(object):
+    """
+    Packs uint8 images of a single shape into a few raw binary shard files, instead of a file per image.
+    index.json records the shape, the categories and the label (-1 for a removed record) of every record,
+    a record is referenced as "<shard file>#<record number>".
+    """
+
+    def __init__(self, folder: str, shape: tuple, classes: list, shard_size: int = 2048):
+        self.folder = folder
+        self.shard_size = shard_size
+        index_path = os.path.join(folder, SHARD_INDEX)
+        if os.path.isfile(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+            if tuple(self.index['shape']) != tuple(shape) or self.index['classes'] != list(classes):
+                raise ValueError("The shards in %s were written with a different shape/categories" % folder)
+        else:
+            self.index = {'shape': list(shape), 'classes': list(classes), 'shards': []}
+        os.makedirs(os.path.join(folder, 'shards'), exist_ok=True)
+        self.shard_file = None
+
+    def write(self, label: str, name: str, img: np.ndarray) -> str:
+        """
+        Appends an image to the current shard
+        :param label: The image category
+        :param name: The image name (kept in the index)
+        :param img: The image, must have the shard shape
+        :return: The record reference
+        """
+        if img.shape != tuple(self.index['shape']) or img.dtype != np.uint8:
+            raise ValueError("Expected a uint8 image of shape %s" % (self.index['shape'],))
+        shards = self.index['shards']
+        if len(shards) == 0 or len(shards[-1]['labels']) >= self.shard_size:
+            self._closeShard()
+            shards.append({'file': 'shards/shard-%05d.u8' % len(shards), 'labels': [], 'names': []})
+        if self.shard_file is None:
+            shard_path = os.path.join(self.folder, shards[-1]['file'])
+            # Drop any bytes written after the last index update
+            if os.path.isfile(shard_path):
+                os.truncate(shard_path, len(shards[-1]['labels']) * img.nbytes)
+            self.shard_file = open(shard_path, 'ab')
+
+        shard = shards[-1]
+        self.shard_file.write(np.ascontiguousarray(img).tobytes())
+        shard['labels'].append(self.index['classes'].index(label))
+        shard['names'].append(name)
+        return shard['file'] + SHARD_SEP + str(len(shard['labels']) - 1)
+
+    def _record(self, ref: str) -> (dict, int):
+        shard_file, rec_idx = ref.rsplit(SHARD_SEP, 1)
+        for shard in self.index['shards']:
+            if shard['file'] == shard_file and int(rec_idx) < len(shard['labels']):
+                return shard, int(rec_idx)
+        return None, None
+
+    def exists(self, ref: str) -> bool:
+        shard, rec_idx = self._record(ref)
+        return shard is not None and shard['labels'][rec_idx] >= 0
+
+    def remove(self, ref: str):
+        """
+        Drops a record from the index, its bytes stay in the shard
+        """
+        shard, rec_idx = self._record(ref)
+        if shard is not None:
+            shard['labels'][rec_idx] = -1
+
+    def _closeShard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+
+    def flush(self):
+        """
+        Writes the index, records are only visible to the readers after a flush
+        """
+        if self.shard_file is not None:
+            self.shard_file.flush()
+        index_path = os.path.join(self.folder, SHARD_INDEX)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def close(self):
+        self.flush()
+        self._closeShard()
+
+
+def isShardFolder(img_folder: str) -> bool:
+    return os.path.isfile(os.path.join(img_folder, SHARD_INDEX))
+
+
+def loadShardIndex(img_folder: str) -> dict:
+    with open(os.path.join(img_folder, SHARD_INDEX)) as f:
+        return json.load(f)
+
+
+_shard_maps = dict()
+
+
+def _readShardRecord(ref: str) -> np.ndarray:
+    """
+    Reads a record of a shard folder, the shards are memory-mapped once per process
+    :param ref: "<shard folder>/shards/<shard file>#<record number>"
+    """
+    shard_path, rec_idx = ref.rsplit(SHARD_SEP, 1)
+    if shard_path not in _shard_maps:
+        img_folder = os.path.dirname(os.path.dirname(shard_path))
+        shape = tuple(loadShardIndex(img_folder)['shape'])
+        records = np.memmap(shard_path, dtype=np.uint8, mode='r')
+        n_records = len(records) // int(np.prod(shape))
+        _shard_maps[shard_path] = records[:n_records * int(np.prod(shape))].reshape((n_records,) + shape)
+    return _shard_maps[shard_path][int(rec_idx)]
+
+
+def listCategories(img_folder: str) -> list:
+    """
+    :return: The category sub-folders of a data folder (other files, e.g. a manifest, are ignored),
+             or the categories of a shard folder. Sorted, so a category gets the same label id
+             whatever the folder format and listdir order
+    """
+    if isShardFolder(img_folder):
+        return sorted(loadShardIndex(img_folder)['classes'])
+    return sorted(x for x in os.listdir(img_folder) if os.path.isdir(os.path.join(img_folder, x)))
+
+
+def listCategoryImages(img_folder: str) -> (list, list):
+    """
+    Lists the images of each category, either the files of the category sub-folders
+    or the records of a shard folder (see ShardWriter)
+    :param img_folder: Base folder for the data
+    :return: categories, a sorted list of image paths/record references for each category
+    """
+    CATEGORIES = listCategories(img_folder)
+    if isShardFolder(img_folder):
+        cat_files = [[] for _ in CATEGORIES]
+        shard_index = loadShardIndex(img_folder)
+        # The records hold the position of their category in the index classes
+        cat_ids = [CATEGORIES.index(x) for x in shard_index['classes']]
+        for shard in shard_index['shards']:
+            shard_path = os.path.join(img_folder, shard['file'])
+            for rec_idx, label in enumerate(shard['labels']):
+                if label >= 0:
+                    cat_files[cat_ids[label]].append(shard_path + SHARD_SEP + str(rec_idx))
+        return CATEGORIES, cat_files
+
+    cat_files = [sorted(os.path.join(img_folder, y, x) for x in os.listdir(os.path.join(img_folder, y))
+                        if os.path.isfile(os.path.join(img_folder, y, x)))
+                 for y in CATEGORIES]
+    return CATEGORIES, cat_files
+
+
+def listImages(img_folder: str, sample_size: int = 3000) -> (list, np.ndarray, list):
+    """
+    Lists the images of a folder that holds a sub-folder per category, or of a shard folder.
+    :param img_folder: Base folder for the data
+    :param sample_size: Maximum samples from each category, non-positive to take the smallest category size
+    :return: image paths, labels, categories
+    """
+    CATEGORIES, cat_files = listCategoryImages(img_folder)
+    max_data_sampeles = min([len(x) for x in cat_files])
     sample_size = min(sample_size, max_data_sampeles)
     sample_size = sample_size if sample_size > 0 else max_data_sampeles
-    for category in CATEGORIES:
-        path = os.path.join(img_folder, category)
-        class_num = CATEGORIES.index(category)
-        c = sample_size
-        for img in tqdm(os.listdir(path)):
-            try:
-                img_array = cv2.imread(os.path.join(path, img), cv2.IMREAD_GRAYSCALE)
-                img_array = cv2.resize(img_array, (img_size, img_size))
-                img_h, img_w = img_array.shape
-                img_array = img_array.reshape((img_h, img_w, 1)).astype(np.float32)
-                training_data.append([img_array, class_num])
-                c -= 1
-                if c == 0:
-                    break
-            except IOError as e:  # in the interest in keeping the output clean...
-                pass
-
-    X = []
-    y = []
-
-    for o_img, label in training_data:
-        X.append(o_img)
-        y.append(label)
-
-    X = np.array(X)
-    y = np.array(y)
 
-    if normalize:
-        X = X / 255.0
+    img_paths = []
+    labels = []
+    for class_num, files in enumerate(cat_files):
+        img_paths += files[:sample_size]
+        labels += [class_num] * len(files[:sample_size])
+
+    return img_paths, np.array(labels), CATEGORIES
+
+
+def _readImage(task: tuple) -> np.ndarray:
+    """
+    Reads a single grayscale image (or shard record) and resizes it, runs inside the worker processes.
+    :param task: (image path, image size)
+    :return: The uint8 image, None if it could not be read
+    """
+    img_path, img_size = task
+    if SHARD_SEP in img_path:
+        img = _readShardRecord(img_path)
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    else:
+        img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    return cv2.resize(img, (img_size, img_size))
+
+
+def decodeImages(img_paths: list, img_size: int, n_workers: int = None,
+                 out: np.ndarray = None, pool: Pool = None) -> (np.ndarray, np.ndarray):
+    """
+    Decodes and resizes grayscale images with a pool of processes, the results are written
+    straight into a preallocated (N, img_size, img_size, 1) array.
+    :param img_paths: The images to load
+    :param img_size: The output height/width
+    :param n_workers: Number of decoding processes, None for all cores, 1 to decode in this process
+    :param out: Optional array to write into (e.g. a memory-map), float32 if not given
+    :param pool: A pool of n_workers processes to use (and keep open) instead of a new one, for repeated calls
+    :return: The images, and a boolean vector of the images that were read successfully
+    """
+    n_imgs = len(img_paths)
+    if out is None:
+        out = np.empty((n_imgs, img_size, img_size, 1), dtype=np.float32)
+    out = out.reshape((n_imgs, img_size, img_size, 1))
+    valid = np.ones(n_imgs, dtype=bool)
+
+    n_workers = n_workers or os.cpu_count() or 1
+    tasks = [(x, img_size) for x in img_paths]
+    own_pool = None
+    if pool is None and n_workers > 1 and n_imgs > 1:
+        pool = own_pool = Pool(min(n_workers, n_imgs))
+    if pool is not None and n_imgs > 1:
+        decoded = pool.imap(_readImage, tasks, chunksize=max(1, min(64, n_imgs // (4 * n_workers))))
+    else:
+        decoded = map(_readImage, tasks)
+
+    try:
+        for i, img in enumerate(tqdm(decoded, total=n_imgs)):
+            if img is None:
+                valid[i] = False
+                continue
+            out[i, :, :, 0] = img
+    finally:
+        if own_pool is not None:
+            own_pool.close()
+            own_pool.join()
+
+    return out, valid
+
+
+def prepareData(img_folder: str = "data/mini_data", img_size: int = 32, sample_size=3000, normalize=False,
+                n_workers: int = None, cache_dir: str = os.path.join('data', 'cache')):
+    """
+    Loads the categorised images as grayscale (N, img_size, img_size, 1) float32 tensors.
+    :param img_folder: Base folder for the data
+    :param img_size: The output height/width
+    :param sample_size: Maximum samples from each category, non-positive to take the smallest category size
+    :param normalize: True to scale the images to [0, 1]
+    :param n_workers: Number of decoding processes, None for all cores
+    :param cache_dir: Where to keep the preprocessed data between runs, None to disable the cache
+    :return: train_x, test_x, train_y, test_y
+    """
+    # The key stats every file of the folder, only worth it with a cache
+    key = None
+    if cache_dir is not None:
+        key = cacheKey(img_folder, loader='prepareData', categories=listCategories(img_folder), img_size=img_size,
+                       sample_size=sample_size, normalize=normalize)
+    cached = loadCache(cache_dir, key)
+    if cached is not None:
+        X, y = cached
+    else:
+        img_paths, y, _ = listImages(img_folder, sample_size)
+        X, valid = decodeImages(img_paths, img_size, n_workers=n_workers)
+        if not valid.all():
+            X, y = X[valid], y[valid]
+
+        if normalize:
+            X /= 255.0
+        saveCache(cache_dir, key, X, y)
 
     return NOT_SK_LEARN_train_test_split(X, y, test_size=0.3, random_state=24)
 
 
+SEG_CATEGORIES = {'Fish': 0, 'Gravel': 1, 'Flower': 2, 'Sugar': 3}
+
+
 def prepareSegData(img_list_file: str = "data/train.csv", img_folder: str = "data/mini_data", img_size: int = 32,
                    sample_size=3000, normalize=False):
-    kCATAGORIES = {'Fish': 0, 'Gravel': 1, 'Flower': 2, 'Sugar': 3}
-
     data = pd.read_csv(img_list_file)
     data = data[data['EncodedPixels'].isnull() == False]
     image_label_data = dict()
 
-    samp_counter = sample_size * len(kCATAGORIES)
-    for row in tqdm(data.iterrows()):
-        img_name, img_type = row[1][0].split('_')
-        img_path = os.path.join(img_folder, img_name)
+    samp_counter = sample_size * len(SEG_CATEGORIES)
+    for label, rle in tqdm(zip(data.iloc[:, 0], data.iloc[:, 1]), total=len(data)):
+        img_name, img_type = label.split('_')
 
-        img = cv2.imread(img_path).astype(np.float)
-        h, w, _ = img.shape
-        mask = rle_to_mask(row[1][1], w, h, norm=normalize)
+        if img_name not in image_label_data.keys():
+            img_path = os.path.join(img_folder, img_name)
+            img = cv2.imread(img_path).astype(np.float32)
+            h, w, _ = img.shape
 
-        img = cv2.resize(img, (img_size, img_size))
-        if normalize:
-            img = img / 255.
-        mask = cv2.resize(mask, (img_size, img_size))
-        h, w, _ = img.shape
+            img = cv2.resize(img, (img_size, img_size))
+            if normalize:
+                img = img / 255.
+            multi_mask = np.zeros((img_size, img_size, len(SEG_CATEGORIES)), dtype=np.float32)
+            image_label_data[img_name] = [img, multi_mask, (w, h)]
 
-        if img_name not in image_label_data.keys():
-            multi_mask = np.zeros((h, w, len(kCATAGORIES)), dtype=np.float)
-            image_label_data[img_name] = [img, multi_mask]
-        image_label_data[img_name][1][:, :, kCATAGORIES[img_type]] = mask
+        # The mask is rasterized directly at the output size
+        w, h = image_label_data[img_name][2]
+        mask = rle_to_mask(rle, w, h, norm=normalize, out_size=(img_size, img_size))
+        image_label_data[img_name][1][:, :, SEG_CATEGORIES[img_type]] = mask
 
         samp_counter -= 1
         if samp_counter == 0:
@@ -145,17 +624,184 @@ def prepareSegData(img_list_file: str = "data/train.csv", img_folder: str = "dat
     image_label_data = list(image_label_data.values())
     np.random.shuffle(image_label_data)
 
-    X = []
-    y = []
-    for img, seg_label in image_label_data:
-        X.append(
-            img.reshape(img_size, img_size, 3)
-        )
-        y.append(
-            seg_label.reshape(img_size, img_size, 4)
-        )
+    X = np.empty((len(image_label_data), img_size, img_size, 3), dtype=np.float32)
+    y = np.empty((len(image_label_data), img_size, img_size, len(SEG_CATEGORIES)), dtype=np.float32)
+    for i, (img, seg_label, _) in enumerate(image_label_data):
+        X[i] = img.reshape(img_size, img_size, 3)
+        y[i] = seg_label
+
+    return NOT_SK_LEARN_train_test_split(X, y)
+
+
+def _decodeImageTF(img_path, channels: int):
+    """
+    Reads a single image inside a tf.data pipeline, color images are returned as BGR to match cv2.imread.
+    """
+    import tensorflow as tf
+
+    img = tf.io.decode_image(tf.io.read_file(img_path), channels=channels, expand_animations=False)
+    if channels == 3:
+        img = tf.reverse(img, axis=[-1])
+    return img
+
+
+def _resizeImageTF(img, img_size: int, normalize: bool):
+    """
+    Resizes a decoded image to a float32 img_size X img_size tensor, in [0, 255] or [0, 1]
+    """
+    import tensorflow as tf
+
+    img = tf.image.resize(tf.cast(img, tf.float32), (img_size, img_size))
+    if normalize:
+        img = img / 255.
+    return img
+
+
+def _streamDataset(ds, n_samples: int, batch_size: int, shuffle_buffer: int, decode_fn, decode_first=False):
+    """
+    Shuffles the (cheap) per-sample records, then decodes in parallel, batches and prefetches,
+    so only shuffle_buffer records and a few decoded batches are ever in memory.
+    With decode_first the decoded (resized) samples are shuffled instead, for records that are
+    bigger than the samples (e.g. raw shard records).
+    """
+    import tensorflow as tf
+
+    if decode_first:
+        ds = ds.map(decode_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if shuffle_buffer is not None:
+        ds = ds.shuffle(min(shuffle_buffer, n_samples) or 1, reshuffle_each_iteration=True)
+    if not decode_first:
+        ds = ds.map(decode_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return ds.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def _shardRecordsDataset(img_folder: str, refs: np.ndarray, labels: np.ndarray):
+    """
+    Reads shard records (see ShardWriter) as (raw bytes, label), each shard is read sequentially as a
+    whole and the records that are not in refs are dropped, so no file is opened per image.
+    :return: The dataset, the record shape
+    """
+    import tensorflow as tf
+
+    index = loadShardIndex(img_folder)
+    shape = index['shape']
+    rec_labels = {os.path.join(img_folder, x['file']): np.full(len(x['labels']), -1, dtype=np.int64)
+                  for x in index['shards']}
+    for ref, label in zip(refs, labels):
+        shard_path, rec_idx = ref.rsplit(SHARD_SEP, 1)
+        rec_labels[shard_path][int(rec_idx)] = label
+
+    ds = None
+    for shard_path, shard_labels in rec_labels.items():
+        # Records written after the last index update are ignored
+        shard_ds = tf.data.FixedLengthRecordDataset(shard_path, int(np.prod(shape))).take(len(shard_labels))
+        shard_ds = tf.data.Dataset.zip((shard_ds, tf.data.Dataset.from_tensor_slices(shard_labels)))
+        ds = shard_ds if ds is None else ds.concatenate(shard_ds)
+    return ds.filter(lambda record, label: label >= 0), shape
+
+
+def prepareDataset(img_folder: str = "data/mini_data", img_size: int = 32, sample_size=3000, normalize=False,
+                   batch_size: int = 128, shuffle_buffer: int = 10000):
+    """
+    Streaming version of prepareData, the images are read from disk while the model trains.
+    Uses the same samples and train/test split as prepareData.
+    :param img_folder: Base folder for the data (category sub-folders or a shard folder)
+    :param img_size: The output height/width
+    :param sample_size: Maximum samples from each category, non-positive to take the smallest category size
+    :param normalize: True to scale the images to [0, 1]
+    :param batch_size: Batch size
+    :param shuffle_buffer: Number of image paths to shuffle over (decoded images for a shard folder),
+                           the test set is not shuffled, so its first batch is a fixed set of samples to display
+    :return: train dataset, test dataset, number of train samples. The datasets yield (image, label) batches
+    """
+    import tensorflow as tf
+
+    img_paths, labels, _ = listImages(img_folder, sample_size)
+    train_x, test_x, train_y, test_y = NOT_SK_LEARN_train_test_split(np.array(img_paths), labels,
+                                                                     test_size=0.3, random_state=24)
+
+    if isShardFolder(img_folder):
+        train_records, shape = _shardRecordsDataset(img_folder, train_x, train_y)
+        test_records, _ = _shardRecordsDataset(img_folder, test_x, test_y)
+
+        def decodeRecord(record, label):
+            img = tf.reshape(tf.io.decode_raw(record, tf.uint8), shape)
+            if len(shape) == 2:
+                img = tf.expand_dims(img, -1)
+            elif shape[-1] == 3:
+                img = tf.image.rgb_to_grayscale(tf.reverse(img, axis=[-1]))
+            return _resizeImageTF(img, img_size, normalize), label
+
+        train_ds = _streamDataset(train_records, len(train_x), batch_size, shuffle_buffer, decodeRecord,
+                                  decode_first=True)
+        test_ds = _streamDataset(test_records, len(test_x), batch_size, None, decodeRecord, decode_first=True)
+        return train_ds, test_ds, len(train_x)
+
+    def decode(img_path, label):
+        return _resizeImageTF(_decodeImageTF(img_path, 1), img_size, normalize), label
+
+    train_ds = _streamDataset(tf.data.Dataset.from_tensor_slices((train_x, train_y)),
+                              len(train_x), batch_size, shuffle_buffer, decode)
+    test_ds = _streamDataset(tf.data.Dataset.from_tensor_slices((test_x, test_y)),
+                             len(test_x), batch_size, None, decode)
+    return train_ds, test_ds, len(train_x)
 
-    X = np.array(X).astype(np.float)
-    y = np.array(y).astype(np.float)
 
-    return NOT_SK_LEARN_train_test_split
+def _segMasks(rles: list, height: int, width: int, img_size: int, normalize: bool) -> np.ndarray:
+    """
+    Decodes the per-category RLE masks of an image to a (img_size, img_size, n_categories) tensor.
+    """
+    masks = np.zeros((img_size, img_size, len(rles)), dtype=np.float32)
+    for i, rle in enumerate(rles):
+        if rle:
+            masks[:, :, i] = rle_to_mask(rle, width, height, norm=normalize, out_size=(img_size, img_size))
+    return masks
+
+
+def prepareSegDataset(img_list_file: str = "data/train.csv", img_folder: str = "data/mini_data",
+                      img_size: int = 32, sample_size=3000, normalize=False,
+                      batch_size: int = 64, shuffle_buffer: int = 10000):
+    """
+    Streaming version of prepareSegData, the images and masks are decoded while the model trains.
+    :param img_list_file: The csv file with the RLE masks
+    :param img_folder: The images folder
+    :param img_size: The output height/width
+    :param sample_size: Number of samples from each category, non-positive for all
+    :param normalize: True to scale the images and masks to [0, 1]
+    :param batch_size: Batch size
+    :param shuffle_buffer: Number of images to shuffle over, the test set is not shuffled (see prepareDataset)
+    :return: train dataset, test dataset, number of train samples. The datasets yield (image, masks) batches
+    """
+    import tensorflow as tf
+
+    data = pd.read_csv(img_list_file)
+    data = data[data['EncodedPixels'].isnull() == False]
+    if sample_size > 0:
+        data = data[:sample_size * len(SEG_CATEGORIES)]
+
+    image_rles = dict()
+    for label, rle in zip(data.iloc[:, 0], data.iloc[:, 1]):
+        img_name, img_type = label.split('_')
+        if img_name not in image_rles:
+            image_rles[img_name] = [''] * len(SEG_CATEGORIES)
+        image_rles[img_name][SEG_CATEGORIES[img_type]] = rle
+
+    img_paths = np.array([os.path.join(img_folder, x) for x in image_rles.keys()])
+    # The RLEs stay in a Python list, the dataset only holds an index into it: a numpy string array would be
+    # fixed-width (the longest RLE) and the dataset tensors would copy all of them
+    rles = list(image_rles.values())
+    train_x, test_x, train_y, test_y = NOT_SK_LEARN_train_test_split(img_paths, np.arange(len(rles)), test_size=0.3)
+
+    def decode(img_path, rle_idx):
+        img = _decodeImageTF(img_path, 3)
+        img_shape = tf.shape(img)
+        masks = tf.numpy_function(lambda i, h, w: _segMasks(rles[int(i)], int(h), int(w), img_size, normalize),
+                                  [rle_idx, img_shape[0], img_shape[1]], tf.float32)
+        masks.set_shape((img_size, img_size, len(SEG_CATEGORIES)))
+        return _resizeImageTF(img, img_size, normalize), masks
+
+    train_ds = _streamDataset(tf.data.Dataset.from_tensor_slices((train_x, train_y)),
+                              len(train_x), batch_size, shuffle_buffer, decode)
+    test_ds = _streamDataset(tf.data.Dataset.from_tensor_slices((test_x, test_y)),
+                             len(test_x), batch_size, None, decode)
+    return train_ds, test_ds, len(train_x)